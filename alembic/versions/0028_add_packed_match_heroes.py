@@ -0,0 +1,80 @@
+"""matches: упакованные списки героев (radiant/dire_heroes_packed).
+
+Revision ID: 0028
+Revises: 0027
+Create Date: 2026-10-16
+
+radiant_heroes / dire_heroes хранятся JSON-строкой (~20 байт на сторону),
+и пересчёт агрегатов (recalculate_all_aggregates /
+delete_matches_and_recalculate) гоняет json.loads дважды на каждый матч.
+Добавляем рядом те же списки little-endian uint16 (LargeBinary: BYTEA на
+PG, BLOB на SQLite; 5 героев = 10 байт) — они читаются struct.unpack без
+парсера. JSON-колонки остаются и пишутся тем же INSERT: SQL-пересчёт на
+PostgreSQL (json_array_elements_text) читает именно их, а packed читают
+только Python-пути (пересчёт на SQLite, вычитание при очистке, миниигра).
+Значит, это +~20 байт данных (+заголовки BYTEA) на строку matches поверх
+JSON — осознанная плата за CPU пересчёта, а не замена хранения. NULL в
+packed означает «читай JSON» (stats_db._unpack_heroes).
+
+Существующие строки дозаполняем пачками. Идемпотентно (inspector +
+WHERE ... IS NULL).
+"""
+
+import json
+import struct
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+revision: str = "0028"
+down_revision: Union[str, None] = "0027"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+_TABLE = "matches"
+_COLUMNS = ("radiant_heroes_packed", "dire_heroes_packed")
+_BATCH = 5000
+
+
+def _pack(raw: str) -> bytes:
+    heroes = json.loads(raw or "[]")
+    return struct.pack(f"<{len(heroes)}H", *heroes)
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    insp = sa.inspect(bind)
+    if _TABLE not in set(insp.get_table_names()):
+        return   # таблицу сразу с колонками создаст create_all
+    existing = {c["name"] for c in insp.get_columns(_TABLE)}
+    for col in _COLUMNS:
+        if col not in existing:
+            op.add_column(_TABLE, sa.Column(col, sa.LargeBinary(), nullable=True))
+
+    select = sa.text(
+        "SELECT match_id, radiant_heroes, dire_heroes FROM matches "
+        "WHERE radiant_heroes_packed IS NULL ORDER BY match_id LIMIT :n"
+    )
+    update = sa.text(
+        "UPDATE matches SET radiant_heroes_packed = :r, dire_heroes_packed = :d "
+        "WHERE match_id = :id"
+    )
+    while True:
+        rows = bind.execute(select, {"n": _BATCH}).fetchall()
+        if not rows:
+            break
+        bind.execute(
+            update,
+            [{"id": mid, "r": _pack(rh), "d": _pack(dh)} for mid, rh, dh in rows],
+        )
+
+
+def downgrade() -> None:
+    insp = sa.inspect(op.get_bind())
+    if _TABLE not in set(insp.get_table_names()):
+        return
+    existing = {c["name"] for c in insp.get_columns(_TABLE)}
+    for col in _COLUMNS:
+        if col in existing:
+            op.drop_column(_TABLE, col)
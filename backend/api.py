@@ -135,6 +135,7 @@ from backend.models import BannedUser as DBBannedUser, UserProfile as DBUserProf
 from backend.db import get_user_id_by_token, create_token_for_user, claim_telegram_init_data, init_tokens_table, init_hero_matchups_cache_table, save_feedback, get_latest_news_guids, is_user_banned, get_banned_user_ids
 from backend.hero_matchups_service import get_hero_matchups_cached, build_matchup_groups
 from backend.hero_stats_service import get_hero_base_winrate
+from backend.opendota_client import close_client as _close_opendota_http_client
 from backend.stats_db import (
     init_stats_tables,
     get_hero_matchup_rows,
@@ -7813,3 +7814,8 @@ async def _bt_start_sweep_task() -> None:
     # «Сыграть с другом» после рестарта платит лишний Telegram-round-trip
     # прямо в обработчике (прод-жалоба: кнопка «молчала» секунды).
     asyncio.create_task(asyncio.to_thread(_bt_bot_username))
+
+
+@app.on_event("shutdown")
+async def _close_opendota_client() -> None:
+    await _close_opendota_http_client()
@@ -2382,6 +2382,16 @@ def main():
 
     application.add_error_handler(error_handler)
 
+    # uvloop приходит вместе с uvicorn[standard] (кроме Windows): API под
+    # uvicorn уже крутится на нём, бот переводим на тот же цикл — дешевле
+    # await'ы на конкурентных запросах к Telegram и OpenDota.
+    try:
+        import uvloop
+    except ImportError:
+        pass
+    else:
+        uvloop.install()
+
     print("✅ Бот запущен! Открой Telegram и напиши боту /start")
     application.run_polling(
         allowed_updates=Update.ALL_TYPES,
@@ -11,7 +11,7 @@ database.py — Central database configuration for the Dota Mini App.
 import os
 from typing import Generator
 
-from sqlalchemy import create_engine, event, text
+from sqlalchemy import create_engine, event, make_url, text
 from sqlalchemy.orm import declarative_base, sessionmaker
 
 # ---------------------------------------------------------------------------
@@ -41,16 +41,35 @@ if not _is_sqlite:
     _engine_kwargs["max_overflow"] = 20     # burst headroom (total max = 30)
     _engine_kwargs["pool_pre_ping"] = True  # re-connect on stale sockets
     _engine_kwargs["pool_recycle"] = 1800   # recycle connections every 30 min
+    if make_url(DATABASE_URL).get_driver_name() == "psycopg2":
+        # text() executemany (UPDATE/DELETE/upsert batches) goes through
+        # psycopg2.extras.execute_batch — pages of statements per round-trip
+        # instead of one round-trip per parameter set. Page of 500 (default
+        # 100): our batches are small rows, so fewer, larger pages win.
+        _engine_kwargs["executemany_mode"] = "values_plus_batch"
+        _engine_kwargs["executemany_batch_page_size"] = 500
 
 engine = create_engine(DATABASE_URL, **_engine_kwargs)
 
 # SQLite-specific: WAL mode + relaxed fsync for better read/write concurrency.
-# These PRAGMAs are global (file-level), so setting them once at connect is enough.
+# journal_mode=WAL is persisted in the database file header, so it is set once
+# on the engine's first connection (first_connect) — re-issuing it on every
+# connection only re-reads the header. synchronous/temp_store/mmap_size/
+# cache_size are per-connection, so they are applied on every new DBAPI
+# connection. temp_store=MEMORY keeps sort/GROUP BY scratch off disk, mmap
+# (1 GiB) lets reads skip the read() syscall copy, cache_size=-65536 = 64 MiB
+# page cache.
 if _is_sqlite:
+    @event.listens_for(engine, "first_connect")
+    def _set_sqlite_journal_mode(dbapi_conn, _record) -> None:
+        dbapi_conn.execute("PRAGMA journal_mode=WAL")
+
     @event.listens_for(engine, "connect")
     def _set_sqlite_pragmas(dbapi_conn, _record) -> None:
-        dbapi_conn.execute("PRAGMA journal_mode=WAL")
         dbapi_conn.execute("PRAGMA synchronous=NORMAL")
+        dbapi_conn.execute("PRAGMA temp_store=MEMORY")
+        dbapi_conn.execute("PRAGMA mmap_size=1073741824")
+        dbapi_conn.execute("PRAGMA cache_size=-65536")
 
 # ---------------------------------------------------------------------------
 # Session + Base
@@ -11,6 +11,7 @@ don't need to be modified.
 
 import logging
 import sys
+from contextlib import nullcontext
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
@@ -62,25 +63,29 @@ def create_token_for_user(user_id: int) -> str:
     token_str = secrets.token_urlsafe(32)
     expires_at = datetime.utcnow() + timedelta(hours=24)
 
+    # Одна транзакция из трёх пишущих statement'ов. Первый же из них — DELETE,
+    # так что write-лок берётся сразу (без апгрейда read → write, ради
+    # которого понадобился бы BEGIN IMMEDIATE), а лишние сессии срезаются
+    # одним bulk-DELETE вместо SELECT + DELETE на каждую строку.
     with SessionLocal() as session:
         session.query(Token).filter(
             Token.user_id == user_id,
             Token.expires_at < datetime.utcnow(),
         ).delete(synchronize_session=False)
-        token_obj = Token(
+        session.add(Token(
             token=_token_digest(token_str), user_id=user_id, expires_at=expires_at
-        )
-        session.add(token_obj)
+        ))
         session.flush()
         excess = (
-            session.query(Token)
+            session.query(Token.token)
             .filter(Token.user_id == user_id)
             .order_by(Token.expires_at.desc(), Token.token.desc())
             .offset(_MAX_ACTIVE_TOKENS_PER_USER)
-            .all()
+            .scalar_subquery()
+        )
+        session.query(Token).filter(Token.token.in_(excess)).delete(
+            synchronize_session=False
         )
-        for old in excess:
-            session.delete(old)
         session.commit()
 
     return token_str
@@ -167,14 +172,24 @@ def cleanup_expired_tokens() -> int:
 # Hero matchups cache
 # ---------------------------------------------------------------------------
 
-def get_hero_matchups_from_cache(hero_id: int) -> tuple[list[dict], str | None]:
+def _session_scope(session):
+    """Caller-owned session when given (left open), otherwise a fresh one."""
+    return nullcontext(session) if session is not None else SessionLocal()
+
+
+def get_hero_matchups_from_cache(
+    hero_id: int, session=None
+) -> tuple[list[dict], str | None]:
     """Reads cached matchup rows for a hero.
 
+    Pass `session` to reuse one session across the read → fetch → write flow
+    (hero_matchups_service); it is not closed or committed here.
+
     Returns:
         - list of dicts {opponent_hero_id, games, wins, winrate, updated_at}
         - max updated_at for this hero_id (or None if no rows)
     """
-    with SessionLocal() as session:
+    with _session_scope(session) as session:
         rows = (
             session.query(HeroMatchupsCache)
             .filter(HeroMatchupsCache.hero_id == hero_id)
@@ -324,10 +339,13 @@ def upsert_user_profile_settings(
 
 
 def replace_hero_matchups_in_cache(
-    hero_id: int, matchups: list[dict], updated_at: str
+    hero_id: int, matchups: list[dict], updated_at: str, session=None
 ) -> None:
-    """Atomically replaces all cached matchup rows for a hero."""
-    with SessionLocal() as session:
+    """Atomically replaces all cached matchup rows for a hero.
+
+    Commits on the given `session` (if any) but leaves it open.
+    """
+    with _session_scope(session) as session:
         session.query(HeroMatchupsCache).filter(
             HeroMatchupsCache.hero_id == hero_id
         ).delete(synchronize_session=False)
@@ -1,8 +1,10 @@
+import asyncio
 import logging
 import os
 from datetime import datetime, timedelta
 from typing import Optional
 
+from backend.database import SessionLocal
 from backend.db import get_hero_matchups_from_cache, replace_hero_matchups_in_cache
 from backend.opendota_client import get_hero_matchups as fetch_from_api
 
@@ -17,6 +19,21 @@ WINRATE_STRONG_THRESHOLD = float(os.getenv("HERO_MATCHUPS_STRONG_THRESHOLD", "0.
 WINRATE_WEAK_THRESHOLD = float(os.getenv("HERO_MATCHUPS_WEAK_THRESHOLD", "0.45"))
 MAX_MATCHUPS_PER_GROUP = int(os.getenv("HERO_MATCHUPS_MAX_PER_GROUP", "5"))
 
+# Single-flight по hero_id: при MISS в OpenDota идёт только одна корутина,
+# остальные ждут её лок и читают уже записанный кэш. Героев ~125 — словарь
+# ограничен сам собой.
+_matchup_locks: dict[int, asyncio.Lock] = {}
+
+
+def _is_cache_fresh(last_updated: Optional[str]) -> bool:
+    if last_updated is None:
+        return False
+    try:
+        last_updated_dt = datetime.fromisoformat(last_updated)
+    except ValueError:
+        return False  # некорректная дата → считаем кэш устаревшим
+    return (datetime.utcnow() - last_updated_dt) < timedelta(hours=CACHE_TTL_HOURS)
+
 
 async def get_hero_matchups_cached(hero_id: int) -> list[dict]:
     """Возвращает матчапы героя, используя кэш в SQLite.
@@ -27,53 +44,58 @@ async def get_hero_matchups_cached(hero_id: int) -> list[dict]:
     - OpenDota недоступен, но старый кэш есть → возвращаем устаревший кэш (stale fallback).
     - OpenDota недоступен, кэш пуст → пробрасываем исключение.
     """
-    cached, last_updated = get_hero_matchups_from_cache(hero_id)
-
-    # Определяем свежесть кэша
-    cache_is_fresh = False
-    if last_updated is not None:
-        try:
-            last_updated_dt = datetime.fromisoformat(last_updated)
-            cache_is_fresh = (datetime.utcnow() - last_updated_dt) < timedelta(hours=CACHE_TTL_HOURS)
-        except ValueError:
-            pass  # некорректная дата → считаем кэш устаревшим
-
-    if cache_is_fresh and cached:
-        logger.info("[matchups cache] HIT  hero_id=%s (%d rows)", hero_id, len(cached))
-        return sorted(cached, key=lambda x: x["winrate"], reverse=True)
-
-    logger.info("[matchups cache] MISS hero_id=%s, fetching from OpenDota...", hero_id)
-
-    try:
-        api_data = await fetch_from_api(hero_id)
-    except Exception as exc:
-        if cached:
-            logger.warning(
-                "[matchups cache] OpenDota error (%s), returning stale cache for hero_id=%s",
-                exc, hero_id,
-            )
+    # Одна сессия на весь путь «чтение → решение → запись». Read-транзакцию
+    # закрываем (rollback) перед каждым await — лок и сеть: соединение не
+    # висит idle-in-transaction на время запроса к OpenDota, а сама сессия
+    # переиспользуется для записи.
+    with SessionLocal() as session:
+        cached, last_updated = get_hero_matchups_from_cache(hero_id, session=session)
+        if _is_cache_fresh(last_updated) and cached:
+            logger.info("[matchups cache] HIT  hero_id=%s (%d rows)", hero_id, len(cached))
             return sorted(cached, key=lambda x: x["winrate"], reverse=True)
-        raise
-
-    # OpenDota возвращает: [{"hero_id": int, "games_played": int, "wins": int}, ...]
-    now_iso = datetime.utcnow().isoformat()
-    to_cache: list[dict] = []
-    for entry in api_data:
-        opponent_id = entry.get("hero_id")
-        games = entry.get("games_played", 0)
-        wins = entry.get("wins", 0)
-        if not opponent_id or games == 0:
-            continue
-        to_cache.append({
-            "opponent_hero_id": opponent_id,
-            "games": games,
-            "wins": wins,
-            "winrate": round(wins / games, 4),
-            "updated_at": now_iso,
-        })
-
-    replace_hero_matchups_in_cache(hero_id, to_cache, now_iso)
-    logger.info("[matchups cache] stored %d rows for hero_id=%s", len(to_cache), hero_id)
+        session.rollback()
+
+        lock = _matchup_locks.setdefault(hero_id, asyncio.Lock())
+        async with lock:
+            # Пока ждали лок, другая корутина могла уже обновить кэш — перечитываем.
+            cached, last_updated = get_hero_matchups_from_cache(hero_id, session=session)
+            if _is_cache_fresh(last_updated) and cached:
+                logger.info("[matchups cache] HIT  hero_id=%s (%d rows, after wait)", hero_id, len(cached))
+                return sorted(cached, key=lambda x: x["winrate"], reverse=True)
+            session.rollback()
+
+            logger.info("[matchups cache] MISS hero_id=%s, fetching from OpenDota...", hero_id)
+
+            try:
+                api_data = await fetch_from_api(hero_id)
+            except Exception as exc:
+                if cached:
+                    logger.warning(
+                        "[matchups cache] OpenDota error (%s), returning stale cache for hero_id=%s",
+                        exc, hero_id,
+                    )
+                    return sorted(cached, key=lambda x: x["winrate"], reverse=True)
+                raise
+
+            # OpenDota возвращает: [{"hero_id": int, "games_played": int, "wins": int}, ...]
+            now_iso = datetime.utcnow().isoformat()
+            to_cache: list[dict] = []
+            for entry in api_data:
+                opponent_id = entry.get("hero_id")
+                games = entry.get("games_played", 0)
+                wins = entry.get("wins", 0)
+                if not opponent_id or games == 0:
+                    continue
+                to_cache.append({
+                    "opponent_hero_id": opponent_id,
+                    "games": games,
+                    "wins": wins,
+                    "winrate": round(wins / games, 4),
+                    "updated_at": now_iso,
+                })
+
+            replace_hero_matchups_in_cache(hero_id, to_cache, now_iso, session=session)
+            logger.info("[matchups cache] stored %d rows for hero_id=%s", len(to_cache), hero_id)
 
     return sorted(to_cache, key=lambda x: x["winrate"], reverse=True)
 
@@ -88,7 +110,7 @@ def build_matchup_groups(matchups: list[dict], base_winrate: Optional[float]) ->
     filtered = [m for m in matchups if m["games"] >= MIN_MATCHUPS_GAMES]
 
     if base_winrate is not None:
-        logger.info("[matchups groups] base_winrate=%.4f, filtered=%d", base_winrate, len(filtered))
+        logger.debug("[matchups groups] base_winrate=%.4f, filtered=%d", base_winrate, len(filtered))
 
         # Добавляем advantage в копии записей (не мутируем оригинал кэша)
         enriched = []
@@ -97,9 +119,11 @@ def build_matchup_groups(matchups: list[dict], base_winrate: Optional[float]) ->
             entry["advantage"] = round(entry["winrate"] - base_winrate, 4)
             enriched.append(entry)
 
-        # Диагностика: первые 3 значения
-        sample = [(e["opponent_hero_id"], e["winrate"], e["advantage"]) for e in enriched[:3]]
-        logger.info("[matchups groups] sample (id, wr, adv): %s", sample)
+        # Диагностика: первые 3 значения. Список собираем только при включённом
+        # DEBUG — функция зовётся на каждый запрос героя.
+        if logger.isEnabledFor(logging.DEBUG):
+            sample = [(e["opponent_hero_id"], e["winrate"], e["advantage"]) for e in enriched[:3]]
+            logger.debug("[matchups groups] sample (id, wr, adv): %s", sample)
 
         strong_against = sorted(
             [e for e in enriched if e["advantage"] >= 0 and e["winrate"] >= WINRATE_STRONG_THRESHOLD],
@@ -127,10 +151,9 @@ def build_matchup_groups(matchups: list[dict], base_winrate: Optional[float]) ->
             key=lambda x: x["winrate"],
         )[:MAX_MATCHUPS_PER_GROUP]
 
-    base_wr_str = f"{base_winrate:.4f}" if base_winrate is not None else "None"
-    logger.info(
+    logger.debug(
         "[matchups groups] total=%d filtered(>=%dgames)=%d base_wr=%s strong=%d weak=%d",
         len(matchups), MIN_MATCHUPS_GAMES, len(filtered),
-        base_wr_str, len(strong_against), len(weak_against),
+        base_winrate, len(strong_against), len(weak_against),
     )
     return {"strong_against": strong_against, "weak_against": weak_against}
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import os
 from datetime import datetime, timedelta
@@ -12,6 +13,9 @@ HERO_STATS_TTL_HOURS = int(os.getenv("HERO_STATS_TTL_HOURS", "24"))
 # In-memory кэш: hero_id -> base winrate (0..1)
 _hero_winrates: dict[int, float] = {}
 _last_updated: Optional[datetime] = None
+# Single-flight: при протухшем кэше /heroStats тянет только одна корутина,
+# остальные ждут лок и читают уже обновлённый кэш (нет thundering herd).
+_refresh_lock = asyncio.Lock()
 
 
 def _is_cache_fresh() -> bool:
@@ -57,7 +61,10 @@ async def get_hero_base_winrate(hero_id: int) -> Optional[float]:
     """
     if not _is_cache_fresh():
         try:
-            await _refresh_cache()
+            async with _refresh_lock:
+                # Пока ждали лок, другая корутина могла уже обновить кэш.
+                if not _is_cache_fresh():
+                    await _refresh_cache()
         except Exception as exc:
             if _hero_winrates:
                 logger.warning(
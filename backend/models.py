@@ -16,6 +16,7 @@ from sqlalchemy import (
     ForeignKey,
     Index,
     Integer,
+    LargeBinary,
     SmallInteger,
     String,
     Text,
@@ -257,6 +258,13 @@ class Match(Base):
     # Hero lists stored as JSON strings (json.dumps / json.loads in stats_db.py)
     radiant_heroes = Column(Text, nullable=False)
     dire_heroes = Column(Text, nullable=False)
+    # Те же списки упакованными little-endian uint16 (5 героев = 10 байт,
+    # stats_db._pack_heroes) — копия рядом с JSON, а не замена: это лишние
+    # байты на строку. Python-пересчёт агрегатов читает их через
+    # struct.unpack без JSON-парсера; SQL-пересчёт на PostgreSQL читает JSON.
+    # NULL — строка старше миграции 0028, тогда читается JSON-колонка.
+    radiant_heroes_packed = Column(LargeBinary, nullable=True)
+    dire_heroes_packed = Column(LargeBinary, nullable=True)
 
     __table_args__ = (
         # get_old_match_ids / get_oldest_match_ids (cleanup) и
@@ -1,40 +1,160 @@
+import asyncio
+import functools
+import importlib.util
 import logging
 import os
+import random
+import time
+from types import MappingProxyType
 
 import httpx
 
+# orjson парсит ответы OpenDota в разы быстрее stdlib json; деплой — это
+# git pull без pip install, поэтому до установки пакета работаем на json
+# (оба принимают bytes).
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
 logger = logging.getLogger(__name__)
 
 OPENDOTA_API_KEY = os.getenv("OPENDOTA_API_KEY")
 _BASE_URL = "https://api.opendota.com/api"
 
 
-def _build_params() -> dict:
-    """Добавляет api_key в query-параметры, если ключ задан."""
-    if OPENDOTA_API_KEY:
-        return {"api_key": OPENDOTA_API_KEY}
-    return {}
-
-
-async def get_heroes() -> list[dict]:
-    """GET /api/heroes — возвращает список всех героев.
-
-    Каждый элемент содержит поля: id, localized_name, primary_attr, и др.
-    Поднимает RuntimeError при сетевых или API-ошибках.
+# api_key в query-параметрах, если ключ задан. Ключ читается один раз при
+# импорте, поэтому и словарь собирается один раз (read-only).
+_BASE_PARAMS = MappingProxyType({"api_key": OPENDOTA_API_KEY} if OPENDOTA_API_KEY else {})
+
+
+# Один AsyncClient на процесс: keep-alive пул переиспользует TCP+TLS к
+# api.opendota.com вместо нового рукопожатия на каждый вызов. api_key
+# зашит в params клиента — httpx мержит их с параметрами запроса.
+# HTTP/2 (нужен пакет h2, ставится через httpx[http2]): параллельные
+# запросы идут потоками одного соединения, а повторяющиеся заголовки
+# сжимаются HPACK'ом. Без h2 httpx падает на http2=True, а деплой — git pull
+# без pip install, поэтому включаем его, только если h2 установлен.
+# Accept-Encoding httpx выставляет сам: gzip/deflate всегда, br — когда
+# установлен brotli (httpx[brotli]); JSON OpenDota сжимается в разы.
+_client: httpx.AsyncClient | None = None
+_HTTP2 = importlib.util.find_spec("h2") is not None
+
+
+def _get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            base_url=_BASE_URL,
+            params=dict(_BASE_PARAMS),
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+            timeout=30.0,
+            http2=_HTTP2,
+        )
+    return _client
+
+
+async def close_client() -> None:
+    """Закрывает общий клиент (вызывается на shutdown приложения)."""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+_RETRY_STATUSES = frozenset({429, 502, 503, 504})
+_MAX_ATTEMPTS = 5
+_MAX_BACKOFF_SECONDS = 30.0
+# Общий бюджет на паузы между попытками одного запроса. Вызовы идут прямо из
+# API-хендлеров (MISS кэша матчапов ждёт OpenDota под локом героя), так что
+# ретрай, чья пауза закончилась бы позже дедлайна, не делаем — отдаём ошибку
+# сразу, и вызывающий уходит в stale-кэш. Худший случай: бюджет + один
+# таймаут запроса, а не 5 таймаутов + 4 Retry-After по 30с.
+_RETRY_BUDGET_SECONDS = 5.0
+
+
+def _retry_delay(attempt: int, r: httpx.Response | None) -> float:
+    """Экспоненциальная пауза с jitter; на 429 уважаем Retry-After."""
+    if r is not None and r.status_code == 429:
+        retry_after = r.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return min(float(retry_after), _MAX_BACKOFF_SECONDS)
+    backoff = min(0.5 * 2 ** (attempt - 1), _MAX_BACKOFF_SECONDS)
+    return backoff + random.uniform(0, backoff / 2)
+
+
+# Склейка одинаковых запросов «в полёте»: если тот же (path, params) уже
+# запрошен, новые вызовы ждут ту же задачу, а не шлют дубль в OpenDota.
+# shield — отмена одного ожидающего не отменяет запрос для остальных.
+_inflight: dict[tuple, asyncio.Task] = {}
+
+
+async def _request(
+    ctx: str,
+    path: str,
+    params: dict | None = None,
+    timeout: float | httpx.Timeout = httpx.USE_CLIENT_DEFAULT,
+) -> httpx.Response:
+    key = (path, tuple(sorted((params or {}).items())))
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_fetch(ctx, path, params, timeout))
+        _inflight[key] = task
+        task.add_done_callback(lambda _t, key=key: _inflight.pop(key, None))
+    return await asyncio.shield(task)
+
+
+async def _fetch(
+    ctx: str,
+    path: str,
+    params: dict | None,
+    timeout: float | httpx.Timeout,
+) -> httpx.Response:
+    """GET через общий клиент; возвращает только ответ 200.
+
+    Сетевые ошибки и 429/502/503/504 ретраятся до _MAX_ATTEMPTS раз, пока
+    паузы укладываются в _RETRY_BUDGET_SECONDS от первой попытки —
+    короткий сбой OpenDota превращается в локальное ожидание, долгий (или
+    Retry-After больше бюджета) — в RuntimeError без многоминутного
+    ожидания. Прочие не-200 — сразу RuntimeError.
     """
-    url = f"{_BASE_URL}/heroes"
-    try:
-        async with httpx.AsyncClient() as client:
-            r = await client.get(url, params=_build_params(), timeout=15.0)
-    except httpx.RequestError as e:
-        logger.error("OpenDota network error (get_heroes): %s", e)
-        raise RuntimeError(f"OpenDota network error: {e}") from e
-
-    if r.status_code != 200:
-        logger.error("OpenDota get_heroes returned HTTP %s: %s", r.status_code, r.text[:200])
-        raise RuntimeError(f"OpenDota API returned HTTP {r.status_code}")
-
-    return r.json()
+    deadline = time.monotonic() + _RETRY_BUDGET_SECONDS
+    for attempt in range(1, _MAX_ATTEMPTS + 1):
+        try:
+            r = await _get_client().get(path, params=params, timeout=timeout)
+        except httpx.RequestError as e:
+            delay = _retry_delay(attempt, None)
+            if attempt == _MAX_ATTEMPTS or time.monotonic() + delay > deadline:
+                logger.error("OpenDota network error (%s): %s", ctx, e)
+                raise RuntimeError(f"OpenDota network error: {e}") from e
+            logger.warning("OpenDota network error (%s, attempt %d): %s", ctx, attempt, e)
+            await asyncio.sleep(delay)
+            continue
+
+        if r.status_code in _RETRY_STATUSES and attempt < _MAX_ATTEMPTS:
+            delay = _retry_delay(attempt, r)
+            if time.monotonic() + delay <= deadline:
+                logger.warning("OpenDota %s returned HTTP %s (attempt %d), retrying", ctx, r.status_code, attempt)
+                await asyncio.sleep(delay)
+                continue
+        _check_response(r, ctx)
+        return r
+    raise AssertionError("unreachable")
+
+
+def _check_response(r: httpx.Response, ctx: str) -> None:
+    """Единственное место, где не-200 превращается в RuntimeError.
+
+    В лог идут первые 200 байт тела как есть: r.text декодировал бы всё
+    тело (с детектом кодировки) ради обрезка.
+    """
+    if r.status_code == 200:
+        return
+    logger.error(
+        "OpenDota %s returned HTTP %s: %s",
+        ctx, r.status_code, r.content[:200].decode("utf-8", errors="replace"),
+    )
+    raise RuntimeError(f"OpenDota API returned HTTP {r.status_code}")
 
 
 async def get_hero_stats() -> list[dict]:
@@ -44,19 +164,8 @@ async def get_hero_stats() -> list[dict]:
     и пары {N_pick, N_win} для N = 1..8 (ранговые брекеты).
     Поднимает RuntimeError при сетевых или API-ошибках.
     """
-    url = f"{_BASE_URL}/heroStats"
-    try:
-        async with httpx.AsyncClient() as client:
-            r = await client.get(url, params=_build_params(), timeout=15.0)
-    except httpx.RequestError as e:
-        logger.error("OpenDota network error (get_hero_stats): %s", e)
-        raise RuntimeError(f"OpenDota network error: {e}") from e
-
-    if r.status_code != 200:
-        logger.error("OpenDota get_hero_stats returned HTTP %s: %s", r.status_code, r.text[:200])
-        raise RuntimeError(f"OpenDota API returned HTTP {r.status_code}")
-
-    return r.json()
+    r = await _request("get_hero_stats", "/heroStats", timeout=15.0)
+    return _json_loads(r.content)
 
 
 async def get_hero_matchups(hero_id: int) -> list[dict]:
@@ -65,22 +174,10 @@ async def get_hero_matchups(hero_id: int) -> list[dict]:
     Каждый элемент содержит: hero_id, games_played, wins.
     Поднимает RuntimeError при сетевых или API-ошибках.
     """
-    url = f"{_BASE_URL}/heroes/{hero_id}/matchups"
-    try:
-        async with httpx.AsyncClient() as client:
-            r = await client.get(url, params=_build_params(), timeout=15.0)
-    except httpx.RequestError as e:
-        logger.error("OpenDota network error (get_hero_matchups hero_id=%s): %s", hero_id, e)
-        raise RuntimeError(f"OpenDota network error: {e}") from e
-
-    if r.status_code != 200:
-        logger.error(
-            "OpenDota get_hero_matchups hero_id=%s returned HTTP %s: %s",
-            hero_id, r.status_code, r.text[:200],
-        )
-        raise RuntimeError(f"OpenDota API returned HTTP {r.status_code}")
-
-    return r.json()
+    r = await _request(
+        f"get_hero_matchups hero_id={hero_id}", f"/heroes/{hero_id}/matchups", timeout=15.0,
+    )
+    return _json_loads(r.content)
 
 
 async def get_public_matches(less_than_match_id: int | None = None) -> list[dict]:
@@ -94,28 +191,12 @@ async def get_public_matches(less_than_match_id: int | None = None) -> list[dict
     Returns up to 100 matches per call.
     Raises RuntimeError on network or API errors.
     """
-    url = f"{_BASE_URL}/publicMatches"
-    params = _build_params()
-    params["significant"] = 1
-    params["mmr_descending"] = 1
+    params = {"significant": 1, "mmr_descending": 1}
     if less_than_match_id is not None:
         params["less_than_match_id"] = less_than_match_id
 
-    try:
-        async with httpx.AsyncClient() as client:
-            r = await client.get(url, params=params, timeout=30.0)
-    except httpx.RequestError as e:
-        logger.error("OpenDota network error (get_public_matches): %s", e)
-        raise RuntimeError(f"OpenDota network error: {e}") from e
-
-    if r.status_code != 200:
-        logger.error(
-            "OpenDota get_public_matches returned HTTP %s: %s",
-            r.status_code, r.text[:200],
-        )
-        raise RuntimeError(f"OpenDota API returned HTTP {r.status_code}")
-
-    return r.json()
+    r = await _request("get_public_matches", "/publicMatches", params=params)
+    return _json_loads(r.content)
 
 
 async def get_match_details(match_id: int) -> dict:
@@ -127,22 +208,46 @@ async def get_match_details(match_id: int) -> dict:
 
     Raises RuntimeError on network or API errors.
     """
-    url = f"{_BASE_URL}/matches/{match_id}"
-    try:
-        async with httpx.AsyncClient() as client:
-            r = await client.get(url, params=_build_params(), timeout=30.0)
-    except httpx.RequestError as e:
-        logger.error("OpenDota network error (get_match_details match_id=%s): %s", match_id, e)
-        raise RuntimeError(f"OpenDota network error: {e}") from e
-
-    if r.status_code != 200:
-        logger.error(
-            "OpenDota get_match_details match_id=%s returned HTTP %s: %s",
-            match_id, r.status_code, r.text[:200],
-        )
-        raise RuntimeError(f"OpenDota API returned HTTP {r.status_code}")
+    r = await _request(f"get_match_details match_id={match_id}", f"/matches/{match_id}")
+    return _json_loads(r.content)
+
+
+# Колонки public_matches, которые нужны get_explorer_match_rows.
+_EXPLORER_COLUMNS = "match_id, duration, avg_rank_tier"
 
-    return r.json()
+
+@functools.lru_cache(maxsize=64)
+def _explorer_sql(
+    game_mode: int,
+    lobby_type: int,
+    limit: int,
+    min_match_id: int | None,
+    min_duration: int,
+) -> str:
+    """SQL для /explorer по public_matches (get_explorer_match_rows).
+
+    Все аргументы — hashable скаляры, так что строка кэшируется: стартовый
+    запрос (min_match_id=None) с дефолтами собирается один раз на процесс.
+    """
+    conditions = [
+        f"game_mode = {int(game_mode)}",
+        f"lobby_type = {int(lobby_type)}",
+    ]
+    if min_duration > 0:
+        conditions.append(f"duration >= {int(min_duration)}")
+    if min_match_id:
+        conditions.append(f"match_id > {int(min_match_id)}")
+        order = "ASC"
+    else:
+        order = "DESC"
+
+    where = " AND ".join(conditions)
+    return (
+        f"SELECT {_EXPLORER_COLUMNS} FROM public_matches "
+        f"WHERE {where} "
+        f"ORDER BY match_id {order} "
+        f"LIMIT {int(limit)}"
+    )
 
 
 async def get_explorer_match_rows(
@@ -175,53 +280,15 @@ async def get_explorer_match_rows(
     Response shape: {"rows": [{"match_id": …, "duration": …, …}], "rowCount": …}
     Raises RuntimeError on network or API errors.
     """
-    conditions = [
-        f"game_mode = {game_mode}",
-        f"lobby_type = {lobby_type}",
-    ]
-    if min_duration > 0:
-        conditions.append(f"duration >= {min_duration}")
-    if min_match_id:
-        conditions.append(f"match_id > {min_match_id}")
-        order = "ASC"
-    else:
-        order = "DESC"
-
-    where = " AND ".join(conditions)
-    sql = (
-        f"SELECT match_id, duration, avg_rank_tier FROM public_matches "
-        f"WHERE {where} "
-        f"ORDER BY match_id {order} "
-        f"LIMIT {limit}"
-    )
-    url = f"{_BASE_URL}/explorer"
-    params = _build_params()
-    params["sql"] = sql
-
-    try:
-        async with httpx.AsyncClient() as client:
-            r = await client.get(url, params=params, timeout=30.0)
-    except httpx.RequestError as e:
-        logger.error("OpenDota network error (get_explorer_match_rows): %s", e)
-        raise RuntimeError(f"OpenDota network error: {e}") from e
-
-    if r.status_code != 200:
-        logger.error(
-            "OpenDota get_explorer_match_rows returned HTTP %s: %s",
-            r.status_code, r.text[:200],
-        )
-        raise RuntimeError(f"OpenDota API returned HTTP {r.status_code}")
-
-    data = r.json()
-    rows = data.get("rows") or []
+    sql = _explorer_sql(game_mode, lobby_type, limit, min_match_id, min_duration)
+    r = await _request("get_explorer_match_rows", "/explorer", params={"sql": sql})
+    rows = _json_loads(r.content).get("rows") or []
     return [
         {
-            "match_id":      int(row["match_id"]),
+            "match_id":      int(match_id),
             "duration":      row.get("duration"),
             "avg_rank_tier": row.get("avg_rank_tier"),
         }
         for row in rows
-        if row.get("match_id") is not None
+        if (match_id := row.get("match_id")) is not None
     ]
-
-
@@ -26,39 +26,169 @@ Key convention for matchup/synergy pairs:
   In hero_matchups, `wins` = wins by hero_a (the one with the smaller ID).
 """
 
+import functools
 import json
 import logging
+import struct
 import time
+from collections import Counter
 from datetime import datetime, timedelta, timezone
+from itertools import combinations
 from typing import Optional
 
-from sqlalchemy import text
+from sqlalchemy import bindparam, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 from backend.config import ALLOWED_GAME_MODE_PAIRS, MIN_MATCH_DURATION_SECONDS
 from backend.database import engine
+from backend.models import Match
 from backend.avatar_store import public_avatar_url
 
 logger = logging.getLogger(__name__)
 
 
+# ---------------------------------------------------------------------------
+# Packed hero lists (matches.*_heroes_packed)
+#
+# Stored alongside the JSON columns, not instead of them: the PostgreSQL
+# rebuild expands the JSON in SQL, while the Python paths (SQLite rebuild,
+# cleanup subtraction, minigame) read the packed copy. Every match row
+# carries both forms.
+# ---------------------------------------------------------------------------
+
+def _pack_heroes(heroes: list[int]) -> bytes:
+    """Packs hero IDs as little-endian uint16 (5 heroes → 10 bytes)."""
+    return struct.pack(f"<{len(heroes)}H", *heroes)
+
+
+def _heroes_json(heroes: list[int]) -> str:
+    """JSON column value for a hero list, e.g. "[1,2,3]".
+
+    Hero IDs are plain ints, so a join skips json.dumps' encoder dispatch;
+    json.loads reads the compact form the same as the old "[1, 2, 3]".
+    """
+    return "[" + ",".join(map(str, heroes)) + "]"
+
+
+def _unpack_heroes(packed, raw_json) -> list[int]:
+    """Decodes one side of a match row.
+
+    Uses the packed column when present (struct.unpack, no parser); falls
+    back to the JSON column for rows written before migration 0028.
+    PostgreSQL returns BYTEA as memoryview — struct accepts any buffer.
+    """
+    if packed is not None:
+        return list(struct.unpack(f"<{len(packed) // 2}H", packed))
+    return json.loads(raw_json)
+
+
 # ---------------------------------------------------------------------------
 # Schema init (idempotent; kept for backward compat with stats_updater.py)
 # ---------------------------------------------------------------------------
 
-def _column_exists(conn, table_name: str, column_name: str) -> bool:
-    """Returns True if column exists in table. Uses information_schema on
-    PostgreSQL (no locks taken) and PRAGMA table_info on SQLite (dev)."""
+def _existing_columns(conn, tables: tuple[str, ...]) -> dict[str, set[str]]:
+    """Column names per table, read in one pass (one query on PostgreSQL)."""
     if conn.dialect.name == "sqlite":
-        rows = conn.execute(text(f"PRAGMA table_info({table_name})")).fetchall()
-        return any(r[1] == column_name for r in rows)
-    row = conn.execute(
+        return {
+            t: {r[1] for r in conn.execute(text(f"PRAGMA table_info({t})"))}
+            for t in tables
+        }
+    existing: dict[str, set[str]] = {t: set() for t in tables}
+    rows = conn.execute(
         text(
-            "SELECT column_name FROM information_schema.columns "
-            "WHERE table_name = :t AND column_name = :c"
+            "SELECT table_name, column_name FROM information_schema.columns "
+            "WHERE table_name IN :tables"
+        ).bindparams(bindparam("tables", expanding=True)),
+        {"tables": list(tables)},
+    )
+    for table_name, column_name in rows:
+        existing[table_name].add(column_name)
+    return existing
+
+
+def _required_columns(dialect: str) -> list[tuple[str, str, str]]:
+    """(table, column, type DDL) for every column added after the table's
+    original CREATE. Order matters only for readability of the log line."""
+    blob = "BLOB" if dialect == "sqlite" else "BYTEA"
+    bool_default = "0" if dialect == "sqlite" else "false"
+    return [
+        # Migration 1: rank_bucket (pre-dates the 0001 alembic migration)
+        ("matches", "rank_bucket", "VARCHAR(16)"),
+        # Migrations 2–3: extended per-player columns. Needed when the table
+        # was created by an older code version with only the basic columns.
+        *(("match_players", col, "SMALLINT") for col in ("lane", "lane_role")),
+        *(
+            ("match_players", col, "INTEGER")
+            for col in (
+                "gpm", "xpm", "kills", "deaths", "assists",
+                "hero_damage", "tower_damage", "obs_placed", "sen_placed",
+                "item0", "item1", "item2",
+                "last_hits", "denies", "hero_healing", "net_worth",
+                "item3", "item4", "item5",
+            )
         ),
-        {"t": table_name, "c": column_name},
-    ).fetchone()
-    return row is not None
+        # Migrations 4–5: game_mode / lobby_type
+        ("matches", "game_mode", "SMALLINT"),
+        ("matches", "lobby_type", "SMALLINT"),
+        # Migration 5b: packed hero lists (alembic 0028)
+        ("matches", "radiant_heroes_packed", blob),
+        ("matches", "dire_heroes_packed", blob),
+        # Migration 8: ally_heroes / enemy_heroes on draft_results
+        ("draft_results", "ally_heroes", "JSON"),
+        ("draft_results", "enemy_heroes", "JSON"),
+        # Migration 8b: стадия расстановки позиций (alembic 0018).
+        # Самовосстановление для случая, когда таблицу создал create_all
+        # предыдущего деплоя (ещё без этих колонок), а alembic upgrade не
+        # прогнали: без них ЛЮБОЙ ORM-SELECT battle-эндпоинтов падает
+        # UndefinedColumn → 500.
+        ("draft_battles", "host_positions", "JSON"),
+        ("draft_battles", "guest_positions", "JSON"),
+        # is_bot / is_friendly: boolean DEFAULT кросс-БД (PG: false, SQLite: 0).
+        # NOT NULL с дефолтом, чтобы ALTER на непустой таблице не падал.
+        ("draft_battles", "is_bot", f"BOOLEAN NOT NULL DEFAULT {bool_default}"),
+        ("draft_battles", "is_friendly", f"BOOLEAN NOT NULL DEFAULT {bool_default}"),
+        # Migration 8c: задел под рейтинг битв (alembic 0020).
+        *(
+            ("draft_battles", col, "INTEGER")
+            for col in (
+                "host_rating_before", "host_rating_after",
+                "guest_rating_before", "guest_rating_after",
+            )
+        ),
+        ("user_profiles", "battle_rating", "INTEGER NOT NULL DEFAULT 1000"),
+        # Migration 8d: счётчик живых боёв (состояние калибровки, alembic 0021).
+        ("user_profiles", "battle_games_played", "INTEGER NOT NULL DEFAULT 0"),
+    ]
+
+
+def _apply_column_migrations(conn) -> None:
+    """Adds whichever _required_columns() are missing, in one transaction.
+
+    PostgreSQL gets one ALTER TABLE per table with all missing columns, each
+    ADD COLUMN IF NOT EXISTS so a worker racing another through boot does
+    not fail. SQLite accepts a single ADD COLUMN per ALTER.
+    """
+    required = _required_columns(conn.dialect.name)
+    tables = tuple(dict.fromkeys(table for table, _, _ in required))
+    existing = _existing_columns(conn, tables)
+
+    missing: dict[str, list[tuple[str, str]]] = {}
+    for table, column, ddl in required:
+        if column not in existing[table]:
+            missing.setdefault(table, []).append((column, ddl))
+
+    for table, columns in missing.items():
+        if conn.dialect.name == "sqlite":
+            for column, ddl in columns:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+        else:
+            adds = ", ".join(f"ADD COLUMN IF NOT EXISTS {column} {ddl}" for column, ddl in columns)
+            conn.execute(text(f"ALTER TABLE {table} {adds}"))
+        logger.info(
+            "[stats_db] Migration applied: added to %s: %s",
+            table, ", ".join(column for column, _ in columns),
+        )
 
 
 def init_stats_tables() -> None:
@@ -72,92 +202,25 @@ def init_stats_tables() -> None:
 
     # ------------------------------------------------------------------ #
     # Idempotent column migrations (ALTER TABLE … ADD COLUMN …).          #
-    # Each ADD COLUMN is guarded by an information_schema (or PRAGMA on   #
-    # SQLite) existence check so that on already-migrated databases NO    #
-    # ALTER TABLE is issued at all — avoiding the ACCESS EXCLUSIVE lock   #
-    # that would otherwise contend with live user queries when multiple   #
-    # workers boot simultaneously.                                        #
+    # All required columns are compared against ONE introspection pass    #
+    # (information_schema on PG, PRAGMA on SQLite) so that on already-    #
+    # migrated databases NO ALTER TABLE is issued at all — avoiding the   #
+    # ACCESS EXCLUSIVE lock that would otherwise contend with live user   #
+    # queries when multiple workers boot simultaneously.                  #
     # Why: previously these were try/except blocks; the failed ALTER      #
     # still acquired a brief table-level lock, producing deadlocks on PG  #
-    # during rolling restarts.                                            #
+    # during rolling restarts. See _apply_column_migrations().            #
     # ------------------------------------------------------------------ #
 
-    # Migration 1: add rank_bucket to matches (pre-dates 0001 migration)
     with engine.begin() as conn:
-        if not _column_exists(conn, "matches", "rank_bucket"):
-            conn.execute(text("ALTER TABLE matches ADD COLUMN rank_bucket VARCHAR(16)"))
-            logger.info("[stats_db] Migration applied: added rank_bucket to matches")
-
-    # Migration 2: add extended per-player columns to match_players.
-    # Needed when the table was created before this migration (e.g. from an
-    # older code version that only had the four basic columns).
-    _mp_new_columns = [
-        ("lane",         "ALTER TABLE match_players ADD COLUMN lane SMALLINT"),
-        ("lane_role",    "ALTER TABLE match_players ADD COLUMN lane_role SMALLINT"),
-        ("gpm",          "ALTER TABLE match_players ADD COLUMN gpm INTEGER"),
-        ("xpm",          "ALTER TABLE match_players ADD COLUMN xpm INTEGER"),
-        ("kills",        "ALTER TABLE match_players ADD COLUMN kills INTEGER"),
-        ("deaths",       "ALTER TABLE match_players ADD COLUMN deaths INTEGER"),
-        ("assists",      "ALTER TABLE match_players ADD COLUMN assists INTEGER"),
-        ("hero_damage",  "ALTER TABLE match_players ADD COLUMN hero_damage INTEGER"),
-        ("tower_damage", "ALTER TABLE match_players ADD COLUMN tower_damage INTEGER"),
-        ("obs_placed",   "ALTER TABLE match_players ADD COLUMN obs_placed INTEGER"),
-        ("sen_placed",   "ALTER TABLE match_players ADD COLUMN sen_placed INTEGER"),
-        ("item0",        "ALTER TABLE match_players ADD COLUMN item0 INTEGER"),
-        ("item1",        "ALTER TABLE match_players ADD COLUMN item1 INTEGER"),
-        ("item2",        "ALTER TABLE match_players ADD COLUMN item2 INTEGER"),
-    ]
-    applied: list[str] = []
-    for col_name, ddl in _mp_new_columns:
-        with engine.begin() as conn:
-            if _column_exists(conn, "match_players", col_name):
-                continue
-            conn.execute(text(ddl))
-            applied.append(col_name)
-    if applied:
-        logger.info(
-            "[stats_db] Migration applied: added to match_players: %s",
-            ", ".join(applied),
-        )
+        _apply_column_migrations(conn)
 
-    # Migration 3: add extended per-player stats columns (second batch).
-    _mp_new_columns_v2 = [
-        ("last_hits",    "ALTER TABLE match_players ADD COLUMN last_hits INTEGER"),
-        ("denies",       "ALTER TABLE match_players ADD COLUMN denies INTEGER"),
-        ("hero_healing", "ALTER TABLE match_players ADD COLUMN hero_healing INTEGER"),
-        ("net_worth",    "ALTER TABLE match_players ADD COLUMN net_worth INTEGER"),
-        ("item3",        "ALTER TABLE match_players ADD COLUMN item3 INTEGER"),
-        ("item4",        "ALTER TABLE match_players ADD COLUMN item4 INTEGER"),
-        ("item5",        "ALTER TABLE match_players ADD COLUMN item5 INTEGER"),
-    ]
-    applied_v2: list[str] = []
-    for col_name, ddl in _mp_new_columns_v2:
-        with engine.begin() as conn:
-            if _column_exists(conn, "match_players", col_name):
-                continue
-            conn.execute(text(ddl))
-            applied_v2.append(col_name)
-    if applied_v2:
-        logger.info(
-            "[stats_db] Migration applied: added to match_players: %s",
-            ", ".join(applied_v2),
-        )
-
-    # Migration 4: add game_mode to matches.
-    with engine.begin() as conn:
-        if not _column_exists(conn, "matches", "game_mode"):
-            conn.execute(text("ALTER TABLE matches ADD COLUMN game_mode SMALLINT"))
-            logger.info("[stats_db] Migration applied: added game_mode to matches")
-
-    # Migration 5: add lobby_type to matches.
-    with engine.begin() as conn:
-        if not _column_exists(conn, "matches", "lobby_type"):
-            conn.execute(text("ALTER TABLE matches ADD COLUMN lobby_type SMALLINT"))
-            logger.info("[stats_db] Migration applied: added lobby_type to matches")
-
-    # Migration 6: create match_player_timeline (10-minute snapshots per player).
-    # Uses CREATE TABLE IF NOT EXISTS so it is fully idempotent — no try/except needed.
+    # Fixed-schema DDL (migrations 6–10) runs in ONE transaction: a single
+    # BEGIN/COMMIT (one fsync on SQLite) instead of one per statement. Every
+    # statement is IF NOT EXISTS, so re-running on a ready DB is a no-op.
     with engine.begin() as conn:
+        # Migration 6: create match_player_timeline (10-minute snapshots per player).
+        # Uses CREATE TABLE IF NOT EXISTS so it is fully idempotent — no try/except needed.
         conn.execute(text("""
             CREATE TABLE IF NOT EXISTS match_player_timeline (
                 match_id    BIGINT  NOT NULL,
@@ -172,8 +235,7 @@ def init_stats_tables() -> None:
             )
         """))
 
-    # Migration 7: create app_settings (key-value store for runtime flags).
-    with engine.begin() as conn:
+        # Migration 7: create app_settings (key-value store for runtime flags).
         conn.execute(text("""
             CREATE TABLE IF NOT EXISTS app_settings (
                 key   VARCHAR(64) PRIMARY KEY,
@@ -181,87 +243,14 @@ def init_stats_tables() -> None:
             )
         """))
 
-    # Migration 8: add ally_heroes / enemy_heroes to draft_results.
-    for col_name, ddl in [
-        ("ally_heroes",  "ALTER TABLE draft_results ADD COLUMN ally_heroes JSON"),
-        ("enemy_heroes", "ALTER TABLE draft_results ADD COLUMN enemy_heroes JSON"),
-    ]:
-        with engine.begin() as conn:
-            if _column_exists(conn, "draft_results", col_name):
-                continue
-            conn.execute(text(ddl))
-            logger.info("[stats_db] Migration applied: added %s to draft_results", col_name)
-
-    # Migration 8b: add host/guest_positions to draft_battles (стадия
-    # расстановки позиций, alembic 0018). Самовосстановление для случая,
-    # когда таблицу создал create_all предыдущего деплоя (ещё без этих
-    # колонок), а alembic upgrade не прогнали: без них ЛЮБОЙ ORM-SELECT
-    # battle-эндпоинтов падает UndefinedColumn → 500. Таблица к этому
-    # моменту существует — create_all выше создаёт её на свежих БД сразу
-    # с колонками, и тогда ALTER не выполняется вовсе.
-    for col_name, ddl in [
-        ("host_positions",  "ALTER TABLE draft_battles ADD COLUMN host_positions JSON"),
-        ("guest_positions", "ALTER TABLE draft_battles ADD COLUMN guest_positions JSON"),
-    ]:
-        with engine.begin() as conn:
-            if _column_exists(conn, "draft_battles", col_name):
-                continue
-            conn.execute(text(ddl))
-            logger.info("[stats_db] Migration applied: added %s to draft_battles", col_name)
-
-    # is_bot / is_friendly — отдельно: boolean DEFAULT кросс-БД (PG: false,
-    # SQLite: 0). NOT NULL с дефолтом, чтобы ALTER на непустой таблице не падал.
-    for _bool_col in ("is_bot", "is_friendly"):
-        with engine.begin() as conn:
-            if not _column_exists(conn, "draft_battles", _bool_col):
-                _bool_default = "0" if conn.dialect.name == "sqlite" else "false"
-                conn.execute(text(
-                    f"ALTER TABLE draft_battles ADD COLUMN {_bool_col} BOOLEAN NOT NULL "
-                    f"DEFAULT {_bool_default}"
-                ))
-                logger.info("[stats_db] Migration applied: added %s to draft_battles", _bool_col)
-
-    # Migration 8c: задел под рейтинг битв (alembic 0020). Снимок рейтинга
-    # обеих сторон на draft_battles (nullable) + рейтинг игрока на user_profiles
-    # (NOT NULL DEFAULT 1000). Самовосстановление для тех же случаев, что 8b.
-    for col_name in (
-        "host_rating_before", "host_rating_after",
-        "guest_rating_before", "guest_rating_after",
-    ):
-        with engine.begin() as conn:
-            if _column_exists(conn, "draft_battles", col_name):
-                continue
-            conn.execute(text(
-                f"ALTER TABLE draft_battles ADD COLUMN {col_name} INTEGER"
-            ))
-            logger.info("[stats_db] Migration applied: added %s to draft_battles", col_name)
-    with engine.begin() as conn:
-        if not _column_exists(conn, "user_profiles", "battle_rating"):
-            conn.execute(text(
-                "ALTER TABLE user_profiles ADD COLUMN battle_rating INTEGER "
-                "NOT NULL DEFAULT 1000"
-            ))
-            logger.info("[stats_db] Migration applied: added battle_rating to user_profiles")
-
-    # Migration 8d: счётчик живых боёв (состояние калибровки, alembic 0021).
-    with engine.begin() as conn:
-        if not _column_exists(conn, "user_profiles", "battle_games_played"):
-            conn.execute(text(
-                "ALTER TABLE user_profiles ADD COLUMN battle_games_played INTEGER "
-                "NOT NULL DEFAULT 0"
-            ))
-            logger.info("[stats_db] Migration applied: added battle_games_played to user_profiles")
-
-    # Migration 8e: индекс лидерборда битвы (alembic 0022). IF NOT EXISTS —
-    # кросс-БД идемпотентно (PG и SQLite поддерживают).
-    with engine.begin() as conn:
+        # Migration 8e: индекс лидерборда битвы (alembic 0022). IF NOT EXISTS —
+        # кросс-БД идемпотентно (PG и SQLite поддерживают).
         conn.execute(text(
             "CREATE INDEX IF NOT EXISTS ix_user_profiles_battle_lb "
             "ON user_profiles (battle_games_played, battle_rating)"
         ))
 
-    # Migration 8: create hero_ability_builds (skill build aggregates per hero).
-    with engine.begin() as conn:
+        # Migration 8: create hero_ability_builds (skill build aggregates per hero).
         conn.execute(text("""
             CREATE TABLE IF NOT EXISTS hero_ability_builds (
                 hero_id     INTEGER   NOT NULL,
@@ -273,8 +262,7 @@ def init_stats_tables() -> None:
             )
         """))
 
-    # Migration 9: app_cache (large JSON blobs for OpenDota constants).
-    with engine.begin() as conn:
+        # Migration 9: app_cache (large JSON blobs for OpenDota constants).
         conn.execute(text("""
             CREATE TABLE IF NOT EXISTS app_cache (
                 key        TEXT      NOT NULL,
@@ -284,8 +272,7 @@ def init_stats_tables() -> None:
             )
         """))
 
-    # Migration 10: hero_builds_cache (pre-built Build tab data per hero).
-    with engine.begin() as conn:
+        # Migration 10: hero_builds_cache (pre-built Build tab data per hero).
         conn.execute(text("""
             CREATE TABLE IF NOT EXISTS hero_builds_cache (
                 hero_id    INTEGER   NOT NULL,
@@ -324,6 +311,11 @@ def get_latest_match_patch() -> Optional[str]:
         return None
 
 
+# Fixed read statements used on per-request/per-match paths, built once at
+# import instead of a new text() object (and cache-key walk) on every call.
+_STATS_MODE_SELECT = text("SELECT value FROM app_settings WHERE key = 'stats_mode'")
+
+
 def get_stats_mode() -> str:
     """Returns the current stats mode: 'normal' or 'strict'.
 
@@ -337,9 +329,7 @@ def get_stats_mode() -> str:
     """
     try:
         with engine.connect() as conn:
-            row = conn.execute(
-                text("SELECT value FROM app_settings WHERE key = 'stats_mode'")
-            ).fetchone()
+            row = conn.execute(_STATS_MODE_SELECT).fetchone()
         return row[0] if row else "normal"
     except Exception:
         return "normal"  # table may not exist on first boot
@@ -370,6 +360,56 @@ def set_stats_mode(mode: str) -> None:
     logger.info("[stats_db] stats_mode set to %r", mode)
 
 
+# ---------------------------------------------------------------------------
+# Multi-row inserts
+# ---------------------------------------------------------------------------
+
+# Bind params per statement: stays under SQLite's historic 999-variable limit.
+_MAX_BIND_PARAMS = 900
+
+_MATCH_PLAYER_COLS = (
+    "match_id", "hero_id", "player_slot", "is_radiant",
+    "lane", "lane_role", "gpm", "xpm",
+    "kills", "deaths", "assists",
+    "hero_damage", "tower_damage",
+    "obs_placed", "sen_placed",
+    "item0", "item1", "item2",
+    "last_hits", "denies", "hero_healing", "net_worth",
+    "item3", "item4", "item5",
+)
+_TIMELINE_COLS = ("match_id", "player_slot", "minute", "lh", "dn", "gpm", "xpm", "net_worth")
+
+
+def _insert_rows_ignore(
+    conn, table: str, cols: tuple[str, ...], conflict_cols: tuple[str, ...], rows: list[dict],
+) -> None:
+    """INSERT ... VALUES (...), (...) ON CONFLICT DO NOTHING in as few statements as possible.
+
+    The driver (psycopg2) sends a text() executemany as one statement per
+    row, so a match's burst of player/timeline rows is folded into
+    multi-row VALUES chunks instead — one round-trip per chunk.
+    """
+    chunk = max(1, _MAX_BIND_PARAMS // len(cols))
+    for start in range(0, len(rows), chunk):
+        batch = rows[start:start + chunk]
+        params = {f"{col}_{i}": row[col] for i, row in enumerate(batch) for col in cols}
+        conn.execute(_insert_rows_ignore_sql(table, cols, conflict_cols, len(batch)), params)
+
+
+@functools.lru_cache(maxsize=128)
+def _insert_rows_ignore_sql(
+    table: str, cols: tuple[str, ...], conflict_cols: tuple[str, ...], n_rows: int,
+):
+    """Statement for _insert_rows_ignore, built once per (table, row count)."""
+    values = ", ".join(
+        "(" + ", ".join(f":{col}_{i}" for col in cols) + ")" for i in range(n_rows)
+    )
+    return text(
+        f"INSERT INTO {table} ({', '.join(cols)}) VALUES {values} "
+        f"ON CONFLICT ({', '.join(conflict_cols)}) DO NOTHING"
+    )
+
+
 # ---------------------------------------------------------------------------
 # Timeline helpers
 # ---------------------------------------------------------------------------
@@ -386,32 +426,159 @@ def save_match_player_timeline(match_id: int, players_timeline: list[dict]) -> N
     if not players_timeline:
         return
     with engine.begin() as conn:
-        for row in players_timeline:
-            conn.execute(
-                text("""
-                    INSERT INTO match_player_timeline
-                        (match_id, player_slot, minute,
-                         lh, dn, gpm, xpm, net_worth)
-                    VALUES
-                        (:match_id, :player_slot, :minute,
-                         :lh, :dn, :gpm, :xpm, :net_worth)
-                    ON CONFLICT (match_id, player_slot, minute) DO NOTHING
-                """),
-                {**row, "match_id": match_id},
-            )
+        _insert_rows_ignore(
+            conn, "match_player_timeline", _TIMELINE_COLS, ("match_id", "player_slot", "minute"),
+            [{**row, "match_id": match_id} for row in players_timeline],
+        )
 
 
 # ---------------------------------------------------------------------------
 # Idempotent match ingestion
 # ---------------------------------------------------------------------------
 
+_MATCH_EXISTS = text("SELECT 1 FROM matches WHERE match_id = :id")
+
+
 def match_exists(match_id: int) -> bool:
+    """Single-match existence check.
+
+    Ingest callers should call save_match_and_update_aggregates directly: its
+    ON CONFLICT DO NOTHING insert already reports "already stored" via the
+    return value (on SQLite it runs this check itself, before taking the
+    write lock). To filter a batch of candidate ids use get_existing_match_ids().
+    """
     with engine.connect() as conn:
-        result = conn.execute(
-            text("SELECT 1 FROM matches WHERE match_id = :id"),
-            {"id": match_id},
+        return conn.execute(_MATCH_EXISTS, {"id": match_id}).fetchone() is not None
+
+
+_EXISTING_MATCH_IDS = text(
+    "SELECT match_id FROM matches WHERE match_id IN :ids"
+).bindparams(bindparam("ids", expanding=True))
+
+
+def get_existing_match_ids(match_ids: list[int]) -> set[int]:
+    """Returns the subset of match_ids already stored, in one query per chunk."""
+    found: set[int] = set()
+    with engine.connect() as conn:
+        for start in range(0, len(match_ids), _MAX_BIND_PARAMS):
+            found.update(conn.execute(
+                _EXISTING_MATCH_IDS, {"ids": match_ids[start:start + _MAX_BIND_PARAMS]},
+            ).scalars())
+    return found
+
+
+def _match_aggregate_rows(
+    radiant_heroes: list[int],
+    dire_heroes: list[int],
+    radiant_win: bool,
+) -> tuple[list[tuple], list[tuple], list[tuple]]:
+    """Builds the hero_stats / hero_matchups / hero_synergy rows of one match.
+
+    Rows are key columns followed by (games, wins). Pairs are canonical
+    (hero_a < hero_b); wins counts hero_a for matchups and the pair's team
+    for synergy.
+    """
+    # Win flags resolved once; pairs are ordered with a conditional instead of
+    # min()/max() calls — the smaller id's side decides hero_a's win flag.
+    rw = 1 if radiant_win else 0
+    dw = 1 - rw
+    stats_rows = [(h, 1, rw) for h in radiant_heroes] + [(h, 1, dw) for h in dire_heroes]
+    matchup_rows = [
+        (r, d, 1, rw) if r < d else (d, r, 1, dw)
+        for r in radiant_heroes
+        for d in dire_heroes
+        if r != d
+    ]
+    synergy_rows = [
+        (x, y, 1, won) if x < y else (y, x, 1, won)
+        for heroes, won in ((radiant_heroes, rw), (dire_heroes, dw))
+        for x, y in combinations(heroes, 2)
+    ]
+    return stats_rows, matchup_rows, synergy_rows
+
+
+def _upsert_counts(conn, batches: list[tuple[str, tuple[str, ...], list[tuple]]]) -> None:
+    """Adds (games, wins) deltas to aggregate tables with multi-row VALUES upserts.
+
+    batches — (table, key_cols, rows) per table. Rows with the same key are
+    summed first: PostgreSQL refuses to update the same row twice in one
+    INSERT ... ON CONFLICT. Keys are then sorted so concurrent ingests lock
+    the hot hero_stats / pair rows in the same order and queue behind each
+    other instead of deadlocking. Deltas may be negative (cleanup).
+
+    Rows are cut into chunks of at most _MAX_BIND_PARAMS bind params. On
+    PostgreSQL consecutive chunks are fused into one statement while they
+    fit that budget (all upserts but the last become data-modifying CTEs),
+    so a single match's aggregates cost one round-trip. SQLite has no
+    writable CTEs — one statement per chunk there.
+    """
+    parts = []
+    for table, key_cols, rows in batches:
+        if not rows:
+            continue
+        n_keys = len(key_cols)
+        merged: dict[tuple, list[int]] = {}
+        for row in rows:
+            acc = merged.setdefault(row[:n_keys], [0, 0])
+            acc[0] += row[n_keys]
+            acc[1] += row[n_keys + 1]
+        rows = [(*key, games, wins) for key, (games, wins) in sorted(merged.items())]
+        chunk = _MAX_BIND_PARAMS // (n_keys + 2)
+        parts.extend(
+            ((table, key_cols, len(rows[i:i + chunk])), rows[i:i + chunk])
+            for i in range(0, len(rows), chunk)
+        )
+
+    fuse = conn.dialect.name == "postgresql"
+    groups: list[list] = []
+    n_params = 0
+    for part in parts:
+        size = len(part[1]) * len(part[1][0])
+        if not groups or not fuse or n_params + size > _MAX_BIND_PARAMS:
+            groups.append([])
+            n_params = 0
+        groups[-1].append(part)
+        n_params += size
+    for group in groups:
+        conn.execute(
+            _upsert_counts_sql(tuple(spec for spec, _ in group)),
+            {
+                f"p{k}_{col}_{i}": value
+                for k, ((_, key_cols, _), rows) in enumerate(group)
+                for i, row in enumerate(rows)
+                for col, value in zip((*key_cols, "games", "wins"), row)
+            },
         )
-        return result.fetchone() is not None
+
+
+@functools.lru_cache(maxsize=256)
+def _upsert_counts_sql(specs: tuple[tuple[str, tuple[str, ...], int], ...]):
+    """Statement for _upsert_counts, built once per (table, key_cols, row count) set."""
+    clauses = []
+    for k, (table, key_cols, n_rows) in enumerate(specs):
+        cols = (*key_cols, "games", "wins")
+        values = ", ".join(
+            "(" + ", ".join(f":p{k}_{col}_{i}" for col in cols) + ")" for i in range(n_rows)
+        )
+        clauses.append(
+            f"INSERT INTO {table} ({', '.join(cols)}) VALUES {values}"
+            f" ON CONFLICT ({', '.join(key_cols)}) DO UPDATE SET"
+            f" games = {table}.games + excluded.games,"
+            f" wins = {table}.wins + excluded.wins"
+        )
+    if len(clauses) == 1:
+        return text(clauses[0])
+    ctes = ", ".join(f"u{i} AS ({clause})" for i, clause in enumerate(clauses[:-1]))
+    return text(f"WITH {ctes} {clauses[-1]}")
+
+
+# INSERT INTO matches ... ON CONFLICT (match_id) DO NOTHING, built once at
+# import from the ORM table with the engine's dialect: SQLAlchemy caches the
+# compiled form, so each ingest skips text() bind parsing and compilation.
+_dialect_insert = sqlite_insert if engine.dialect.name == "sqlite" else pg_insert
+_MATCH_INSERT = _dialect_insert(Match.__table__).on_conflict_do_nothing(
+    index_elements=["match_id"],
+)
 
 
 def save_match_and_update_aggregates(
@@ -428,13 +595,17 @@ def save_match_and_update_aggregates(
     lobby_type: Optional[int] = None,
     players: Optional[list[dict]] = None,
     players_timeline: Optional[list[dict]] = None,
-) -> None:
+) -> bool:
     """Atomically saves one match and updates all aggregate tables.
 
     Idempotent: uses INSERT ... ON CONFLICT (match_id) DO NOTHING and skips
     aggregate updates when the row already existed (rowcount == 0).
     This syntax is identical in PostgreSQL 9.5+ and SQLite 3.24+.
 
+    Returns True when the match row was newly inserted, False when it was
+    already stored or blocked by the game-mode gate — so callers can write
+    first instead of probing with match_exists().
+
     game_mode — OpenDota game_mode code (1=All Pick, 22=Ranked All Pick).
       The caller (fetch_and_process_matches) has already filtered out
       disallowed modes; this value is stored as-is for reference.
@@ -452,6 +623,36 @@ def save_match_and_update_aggregates(
       minute, lh, dn, gpm, xpm, net_worth.  Saved to match_player_timeline
       only when the match passes the duration filter (≥ 20 min).
     """
+    if not _match_write_allowed(match_id, game_mode, lobby_type):
+        return False
+
+    # SQLite: a duplicate would still take the database-wide write lock just
+    # for the INSERT to no-op, so a plain read screens re-ingested matches
+    # first. PostgreSQL's ON CONFLICT DO NOTHING only touches the index
+    # entry — there the extra SELECT would be a wasted round-trip.
+    if engine.dialect.name == "sqlite" and match_exists(match_id):
+        return False
+
+    # All parameter building (hero list encoding, per-row dicts, aggregate
+    # pairs) happens before the transaction opens, so the write lock — the
+    # whole database on SQLite, the inserted rows on PostgreSQL — is held
+    # only for the SQL itself.
+    write = _prepare_match_write(
+        match_id, start_time, duration, patch, avg_rank_tier, rank_bucket,
+        radiant_win, radiant_heroes, dire_heroes, game_mode, lobby_type,
+        players, players_timeline,
+    )
+    aggregates = _new_aggregate_batches()
+    with engine.begin() as conn:
+        is_new = _write_match(conn, write, aggregates)
+        _upsert_counts(conn, aggregates)
+        # engine.begin() auto-commits here
+    if is_new:
+        _invalidate_hero_stats_cache()
+    return is_new
+
+
+def _match_write_allowed(match_id: int, game_mode: Optional[int], lobby_type: Optional[int]) -> bool:
     # --- Hard gate: never write a match with missing or disallowed game_mode/lobby_type ---
     # This is the last line of defence: even if a caller skips its own filter
     # (e.g. an old worker process that hasn't been restarted after a deploy),
@@ -462,186 +663,130 @@ def save_match_and_update_aggregates(
             "— not in ALLOWED_GAME_MODE_PAIRS %s. Match will NOT be saved.",
             match_id, game_mode, lobby_type, ALLOWED_GAME_MODE_PAIRS,
         )
-        return
+        return False
+    return True
 
-    logger.info(
-        "[diag] inserting/updating match %s with game_mode=%s, lobby_type=%s",
-        match_id, game_mode, lobby_type,
-    )
-    with engine.begin() as conn:
-        # ----- Insert match (idempotent) -----
-        result = conn.execute(
-            text("""
-                INSERT INTO matches
-                    (match_id, start_time, duration, patch, avg_rank_tier, rank_bucket,
-                     game_mode, lobby_type, radiant_win, radiant_heroes, dire_heroes)
-                VALUES
-                    (:match_id, :start_time, :duration, :patch, :avg_rank_tier, :rank_bucket,
-                     :game_mode, :lobby_type, :radiant_win, :radiant_heroes, :dire_heroes)
-                ON CONFLICT (match_id) DO NOTHING
-            """),
-            {
-                "match_id": match_id,
-                "start_time": start_time,
-                "duration": duration,
-                "patch": patch,
-                "avg_rank_tier": avg_rank_tier,
-                "rank_bucket": rank_bucket,
-                "game_mode": game_mode,
-                "lobby_type": lobby_type,
-                "radiant_win": int(radiant_win),
-                "radiant_heroes": json.dumps(radiant_heroes),
-                "dire_heroes": json.dumps(dire_heroes),
-            },
-        )
 
-        is_new = result.rowcount == 1
+def _prepare_match_write(
+    match_id: int,
+    start_time: int,
+    duration: Optional[int],
+    patch: Optional[str],
+    avg_rank_tier: Optional[int],
+    rank_bucket: Optional[str],
+    radiant_win: bool,
+    radiant_heroes: list[int],
+    dire_heroes: list[int],
+    game_mode: Optional[int] = None,
+    lobby_type: Optional[int] = None,
+    players: Optional[list[dict]] = None,
+    players_timeline: Optional[list[dict]] = None,
+) -> dict:
+    """Builds every parameter one match's write needs, outside any transaction."""
+    return {
+        "match_id": match_id,
+        "duration": duration,
+        "radiant_win": radiant_win,
+        "players": players,
+        "match_params": {
+            "match_id": match_id,
+            "start_time": start_time,
+            "duration": duration,
+            "patch": patch,
+            "avg_rank_tier": avg_rank_tier,
+            "rank_bucket": rank_bucket,
+            "game_mode": game_mode,
+            "lobby_type": lobby_type,
+            "radiant_win": int(radiant_win),
+            "radiant_heroes": _heroes_json(radiant_heroes),
+            "dire_heroes": _heroes_json(dire_heroes),
+            "radiant_heroes_packed": _pack_heroes(radiant_heroes),
+            "dire_heroes_packed": _pack_heroes(dire_heroes),
+        },
+        "player_rows": [{**p, "match_id": match_id} for p in players or ()],
+        "timeline_rows": [{**row, "match_id": match_id} for row in players_timeline or ()],
+        "aggregate_rows": _match_aggregate_rows(radiant_heroes, dire_heroes, radiant_win),
+    }
 
-        logger.info(
-            "[diag] matches upsert done for %s: game_mode=%s, lobby_type=%s  (new_row=%s)",
-            match_id, game_mode, lobby_type, is_new,
-        )
 
-        if not is_new:
-            # Match already in DB — skip aggregate updates to keep counts correct
-            return
-
-        # ----- Duration filter -----
-        # Matches shorter than MIN_MATCH_DURATION_SECONDS (20 min) are stored
-        # in the matches table but excluded from all derivative tables
-        # (match_players, match_player_timeline, hero_stats, hero_matchups, hero_synergy).
-        # duration=None means the API didn't return it — treated as passing.
-        if duration is not None and duration < MIN_MATCH_DURATION_SECONDS:
-            logger.debug(
-                "[stats_db] match %s: duration=%ds < %ds — "
-                "skipped from hero_stats / hero_matchups / hero_synergy",
-                match_id, duration, MIN_MATCH_DURATION_SECONDS,
-            )
-            return
+def _new_aggregate_batches() -> list[tuple[str, tuple[str, ...], list[tuple]]]:
+    """Empty hero_stats / hero_matchups / hero_synergy batches for _upsert_counts."""
+    return [
+        ("hero_stats", ("hero_id",), []),
+        ("hero_matchups", ("hero_a", "hero_b"), []),
+        ("hero_synergy", ("hero_a", "hero_b"), []),
+    ]
 
-        # ----- Insert per-player records (if provided) -----
-        if players:
-            for p in players:
-                conn.execute(
-                    text("""
-                        INSERT INTO match_players
-                            (match_id, hero_id, player_slot, is_radiant,
-                             lane, lane_role, gpm, xpm,
-                             kills, deaths, assists,
-                             hero_damage, tower_damage,
-                             obs_placed, sen_placed,
-                             item0, item1, item2,
-                             last_hits, denies, hero_healing, net_worth,
-                             item3, item4, item5)
-                        VALUES
-                            (:match_id, :hero_id, :player_slot, :is_radiant,
-                             :lane, :lane_role, :gpm, :xpm,
-                             :kills, :deaths, :assists,
-                             :hero_damage, :tower_damage,
-                             :obs_placed, :sen_placed,
-                             :item0, :item1, :item2,
-                             :last_hits, :denies, :hero_healing, :net_worth,
-                             :item3, :item4, :item5)
-                        ON CONFLICT (match_id, player_slot) DO NOTHING
-                    """),
-                    {**p, "match_id": match_id},
-                )
 
-        # ----- Insert 10-minute timeline snapshots (if provided) -----
-        if players_timeline:
-            tl_count = 0
-            for row in players_timeline:
-                conn.execute(
-                    text("""
-                        INSERT INTO match_player_timeline
-                            (match_id, player_slot, minute,
-                             lh, dn, gpm, xpm, net_worth)
-                        VALUES
-                            (:match_id, :player_slot, :minute,
-                             :lh, :dn, :gpm, :xpm, :net_worth)
-                        ON CONFLICT (match_id, player_slot, minute) DO NOTHING
-                    """),
-                    {**row, "match_id": match_id},
-                )
-                tl_count += 1
-            logger.info(
-                "[TIMELINE] saved %d rows for match %s",
-                tl_count, match_id,
-            )
-        else:
-            logger.info(
-                "[TIMELINE] 0 rows for match %s "
-                "(replay arrays lh_t/gold_t/xp_t absent in OpenDota response)",
-                match_id,
-            )
+def _write_match(conn, write: dict, aggregates: list) -> bool:
+    """Writes one prepared match inside the caller's transaction.
 
-        # ----- hero_stats -----
-        for h in radiant_heroes:
-            conn.execute(
-                text("""
-                    INSERT INTO hero_stats (hero_id, games, wins) VALUES (:h, 1, :w)
-                    ON CONFLICT (hero_id) DO UPDATE SET
-                        games = hero_stats.games + 1,
-                        wins  = hero_stats.wins  + excluded.wins
-                """),
-                {"h": h, "w": int(radiant_win)},
-            )
-        for h in dire_heroes:
-            conn.execute(
-                text("""
-                    INSERT INTO hero_stats (hero_id, games, wins) VALUES (:h, 1, :w)
-                    ON CONFLICT (hero_id) DO UPDATE SET
-                        games = hero_stats.games + 1,
-                        wins  = hero_stats.wins  + excluded.wins
-                """),
-                {"h": h, "w": int(not radiant_win)},
-            )
+    The match's aggregate deltas are appended to `aggregates` (see
+    _new_aggregate_batches) — the caller applies them with _upsert_counts.
+    Returns True when the match row was newly inserted.
+    """
+    match_id, duration = write["match_id"], write["duration"]
+    logger.debug(
+        "[diag] inserting/updating match %s with game_mode=%s, lobby_type=%s",
+        match_id, write["match_params"]["game_mode"], write["match_params"]["lobby_type"],
+    )
+    # ----- Insert match (idempotent) -----
+    is_new = conn.execute(_MATCH_INSERT, write["match_params"]).rowcount == 1
+
+    logger.debug("[diag] matches upsert done for %s (new_row=%s)", match_id, is_new)
+
+    if not is_new:
+        # Match already in DB — skip aggregate updates to keep counts correct
+        return False
+
+    # ----- Duration filter -----
+    # Matches shorter than MIN_MATCH_DURATION_SECONDS (20 min) are stored
+    # in the matches table but excluded from all derivative tables
+    # (match_players, match_player_timeline, hero_stats, hero_matchups, hero_synergy).
+    # duration=None means the API didn't return it — treated as passing.
+    if duration is not None and duration < MIN_MATCH_DURATION_SECONDS:
+        logger.debug(
+            "[stats_db] match %s: duration=%ds < %ds — "
+            "skipped from hero_stats / hero_matchups / hero_synergy",
+            match_id, duration, MIN_MATCH_DURATION_SECONDS,
+        )
+        return True
 
-        # ----- hero_matchups -----
-        for r_hero in radiant_heroes:
-            for d_hero in dire_heroes:
-                if r_hero == d_hero:
-                    continue
-                a = min(r_hero, d_hero)
-                b = max(r_hero, d_hero)
-                a_wins = int((r_hero < d_hero) == radiant_win)
-                conn.execute(
-                    text("""
-                        INSERT INTO hero_matchups (hero_a, hero_b, games, wins)
-                        VALUES (:a, :b, 1, :w)
-                        ON CONFLICT (hero_a, hero_b) DO UPDATE SET
-                            games = hero_matchups.games + 1,
-                            wins  = hero_matchups.wins  + excluded.wins
-                    """),
-                    {"a": a, "b": b, "w": a_wins},
-                )
+    # ----- Insert per-player records (if provided) -----
+    if write["player_rows"]:
+        _insert_rows_ignore(
+            conn, "match_players", _MATCH_PLAYER_COLS, ("match_id", "player_slot"),
+            write["player_rows"],
+        )
 
-        # ----- hero_synergy -----
-        for heroes, team_won in [
-            (radiant_heroes, radiant_win),
-            (dire_heroes, not radiant_win),
-        ]:
-            n = len(heroes)
-            for i in range(n):
-                for j in range(i + 1, n):
-                    a = min(heroes[i], heroes[j])
-                    b = max(heroes[i], heroes[j])
-                    conn.execute(
-                        text("""
-                            INSERT INTO hero_synergy (hero_a, hero_b, games, wins)
-                            VALUES (:a, :b, 1, :w)
-                            ON CONFLICT (hero_a, hero_b) DO UPDATE SET
-                                games = hero_synergy.games + 1,
-                                wins  = hero_synergy.wins  + excluded.wins
-                        """),
-                        {"a": a, "b": b, "w": int(team_won)},
-                    )
+    # ----- Insert 10-minute timeline snapshots (if provided) -----
+    timeline_rows = write["timeline_rows"]
+    if timeline_rows:
+        _insert_rows_ignore(
+            conn, "match_player_timeline", _TIMELINE_COLS, ("match_id", "player_slot", "minute"),
+            timeline_rows,
+        )
+        logger.info(
+            "[TIMELINE] saved %d rows for match %s",
+            len(timeline_rows), match_id,
+        )
+    else:
+        logger.info(
+            "[TIMELINE] 0 rows for match %s "
+            "(replay arrays lh_t/gold_t/xp_t absent in OpenDota response)",
+            match_id,
+        )
 
-        # ----- hero_ability_builds -----
-        if players:
-            _upsert_hero_ability_builds(conn, players, radiant_win)
+    # ----- hero_stats / hero_matchups / hero_synergy -----
+    # Deltas only: the caller applies them with multi-row INSERT ... VALUES
+    # upserts, one round-trip per match.
+    for (_, _, rows), match_rows in zip(aggregates, write["aggregate_rows"]):
+        rows.extend(match_rows)
 
-        # engine.begin() auto-commits here
+    # ----- hero_ability_builds -----
+    if write["players"]:
+        _upsert_hero_ability_builds(conn, write["players"], write["radiant_win"])
+    return True
 
 
 # ---------------------------------------------------------------------------
@@ -652,9 +797,11 @@ def _upsert_hero_ability_builds(conn, players: list[dict], radiant_win: bool) ->
     """Upserts hero_ability_builds rows for all players in one match.
 
     Called inside an existing engine.begin() transaction (conn is passed in).
-    Skips players that have no ability_upgrades data.
+    Skips players that have no ability_upgrades data. All builds go out as
+    one multi-row VALUES upsert (same shape as _upsert_counts), merged and
+    key-sorted first for the same reasons.
     """
-    now = datetime.now(timezone.utc).replace(tzinfo=None)  # naive UTC for SQLite compat
+    builds: dict[tuple[int, str], list[int]] = {}
     for p in players:
         raw = p.get("ability_upgrades") or []
         if not raw:
@@ -664,28 +811,44 @@ def _upsert_hero_ability_builds(conn, players: list[dict], radiant_win: bool) ->
             continue
         ability_ids = json.dumps(raw)  # already sliced to 30 by _extract_player_stats
         slot = p.get("player_slot", 128)
-        won = int((slot < 128) == radiant_win)
-        conn.execute(
-            text("""
-                INSERT INTO hero_ability_builds (hero_id, ability_ids, wins, games, updated_at)
-                VALUES (:hero_id, :ability_ids, :wins, 1, :now)
-                ON CONFLICT (hero_id, ability_ids) DO UPDATE SET
-                    wins       = hero_ability_builds.wins  + excluded.wins,
-                    games      = hero_ability_builds.games + 1,
-                    updated_at = excluded.updated_at
-            """),
-            {"hero_id": hero_id, "ability_ids": ability_ids, "wins": won, "now": now},
-        )
+        acc = builds.setdefault((hero_id, ability_ids), [0, 0])
+        acc[0] += 1
+        acc[1] += int((slot < 128) == radiant_win)
+    if not builds:
+        return
+    params = {"now": datetime.now(timezone.utc).replace(tzinfo=None)}  # naive UTC for SQLite compat
+    for i, ((hero_id, ability_ids), (games, wins)) in enumerate(sorted(builds.items())):
+        params.update({
+            f"hero_id_{i}": hero_id, f"ability_ids_{i}": ability_ids,
+            f"games_{i}": games, f"wins_{i}": wins,
+        })
+    conn.execute(_ability_builds_upsert_sql(len(builds)), params)
+
+
+@functools.lru_cache(maxsize=16)
+def _ability_builds_upsert_sql(n_rows: int):
+    """Statement for _upsert_hero_ability_builds, built once per row count."""
+    values = ", ".join(
+        f"(:hero_id_{i}, :ability_ids_{i}, :wins_{i}, :games_{i}, :now)" for i in range(n_rows)
+    )
+    return text(f"""
+        INSERT INTO hero_ability_builds (hero_id, ability_ids, wins, games, updated_at)
+        VALUES {values}
+        ON CONFLICT (hero_id, ability_ids) DO UPDATE SET
+            wins       = hero_ability_builds.wins  + excluded.wins,
+            games      = hero_ability_builds.games + excluded.games,
+            updated_at = excluded.updated_at
+    """)
+
+
+_APP_SETTING_SELECT = text("SELECT value FROM app_settings WHERE key = :k")
 
 
 def get_app_setting(key: str) -> Optional[str]:
     """Returns a value from app_settings by key, or None if not set."""
     try:
         with engine.connect() as conn:
-            row = conn.execute(
-                text("SELECT value FROM app_settings WHERE key = :k"),
-                {"k": key},
-            ).fetchone()
+            row = conn.execute(_APP_SETTING_SELECT, {"k": key}).fetchone()
         return row[0] if row else None
     except Exception:
         return None
@@ -703,14 +866,14 @@ def set_app_setting(key: str, value: str) -> None:
         )
 
 
+_APP_CACHE_SELECT = text("SELECT data FROM app_cache WHERE key = :k")
+
+
 def get_app_cache_value(key: str) -> Optional[dict]:
     """Returns a cached JSON blob from app_cache by key, or None."""
     try:
         with engine.connect() as conn:
-            row = conn.execute(
-                text("SELECT data FROM app_cache WHERE key = :k"),
-                {"k": key},
-            ).fetchone()
+            row = conn.execute(_APP_CACHE_SELECT, {"k": key}).fetchone()
         if row is None:
             return None
         val = row[0]
@@ -736,14 +899,14 @@ def set_app_cache_value(key: str, data: dict) -> None:
         )
 
 
+_HERO_BUILD_CACHE_SELECT = text("SELECT build_data FROM hero_builds_cache WHERE hero_id = :id")
+
+
 def get_hero_build_cache(hero_id: int) -> Optional[dict]:
     """Returns pre-built Build tab data for a hero from hero_builds_cache."""
     try:
         with engine.connect() as conn:
-            row = conn.execute(
-                text("SELECT build_data FROM hero_builds_cache WHERE hero_id = :id"),
-                {"id": hero_id},
-            ).fetchone()
+            row = conn.execute(_HERO_BUILD_CACHE_SELECT, {"id": hero_id}).fetchone()
         if row is None:
             return None
         val = row[0]
@@ -816,11 +979,9 @@ def get_hero_talent_builds(hero_id: int) -> dict:
                         break
             if not aid:
                 continue
-            lc = level_counts.setdefault(level, {})
-            if aid not in lc:
-                lc[aid] = {"games": 0, "wins": 0}
-            lc[aid]["games"] += g
-            lc[aid]["wins"]  += w
+            acc = level_counts.setdefault(level, {}).setdefault(aid, {"games": 0, "wins": 0})
+            acc["games"] += g
+            acc["wins"]  += w
 
     result: dict[int, list] = {}
     for level in sorted(level_counts):
@@ -868,6 +1029,33 @@ def get_hero_ability_build(hero_id: int) -> Optional[dict]:
 # Reads for the API endpoints
 # ---------------------------------------------------------------------------
 
+def _wr_sql(wins: str) -> str:
+    """SQL for round(wins / games, 4) as a float (0.0 when games = 0), both backends."""
+    return f"CAST(COALESCE(ROUND(1.0 * ({wins}) / NULLIF(games, 0), 4), 0) AS DOUBLE PRECISION)"
+
+
+@functools.lru_cache(maxsize=None)
+def _hero_pair_rows_sql(table: str, b_side_wins: str):
+    """(hero_id, games, wins, wr_vs) for every pair involving :id, as UNION ALL.
+
+    `hero_a = :id OR hero_b = :id` tends to plan as a BitmapOr with a heap
+    recheck. Split into two branches, the hero_a side is a range on the PK
+    and the hero_b side a seek on the plain hero_b index. A pair never has
+    hero_a == hero_b, so the branches can't overlap and UNION ALL is exact.
+
+    Each branch already yields the other hero, :id's wins (b_side_wins is
+    the wins expression for the hero_b side) and the rounded win rate, so
+    rows map 1:1 onto the reader's output dicts with no Python arithmetic.
+    """
+    return text(
+        f"SELECT hero_b AS hero_id, games, wins, {_wr_sql('wins')} AS wr_vs FROM {table}"
+        " WHERE hero_a = :id AND games >= :min"
+        " UNION ALL"
+        f" SELECT hero_a, games, {b_side_wins}, {_wr_sql(b_side_wins)} FROM {table}"
+        " WHERE hero_b = :id AND games >= :min"
+    )
+
+
 def get_hero_matchup_rows(hero_id: int, min_games: int = 50, strict: bool = False) -> list[dict]:
     """Returns all opponent matchup rows for a hero (win rate from hero's perspective).
 
@@ -926,38 +1114,58 @@ def get_hero_matchup_rows(hero_id: int, min_games: int = 50, strict: bool = Fals
 
     # --- normal mode: fast pre-computed aggregate ---
     with engine.connect() as conn:
-        rows = conn.execute(
-            text(
-                "SELECT hero_a, hero_b, games, wins FROM hero_matchups"
-                " WHERE (hero_a = :id OR hero_b = :id) AND games >= :min"
-            ),
-            {"id": hero_id, "min": min_games},
-        ).mappings().all()
+        # hero_matchups.wins counts hero_a, so on the hero_b side :id won the rest.
+        return [
+            dict(row) for row in conn.execute(
+                _hero_pair_rows_sql("hero_matchups", "games - wins"),
+                {"id": hero_id, "min": min_games},
+            ).mappings()
+        ]
 
-    result = []
-    for row in rows:
-        hero_a, hero_b, games, wins = row["hero_a"], row["hero_b"], row["games"], row["wins"]
-        if hero_a == hero_id:
-            opponent_id = hero_b
-            hero_wins = wins
-        else:
-            opponent_id = hero_a
-            hero_wins = games - wins
-        result.append(
-            {
-                "hero_id": opponent_id,
-                "games": games,
-                "wins": hero_wins,
-                "wr_vs": round(hero_wins / games, 4) if games > 0 else 0.0,
-            }
-        )
-    return result
 
+# Normal-mode hero_stats lookups. The table is ~125 tiny rows that move by a
+# few games a minute and are read on every hero page, so it is loaded whole
+# in one query and kept for a short TTL. In-process writers clear it
+# (_invalidate_hero_stats_cache); other processes (bot vs API) see new
+# numbers within the TTL.
+_HERO_STATS_TTL_SEC = 60
+_hero_stats_snapshot: Optional[tuple[float, dict[int, tuple[int, int]]]] = None
+_ALL_HERO_STATS_SELECT = text("SELECT hero_id, games, wins FROM hero_stats")
 
-def get_hero_base_winrate_from_db(hero_id: int, strict: bool = False) -> Optional[float]:
-    """Returns hero's overall winrate from our match data.
 
-    strict=False: reads from hero_stats aggregate table (fast).
+def get_all_hero_stats() -> dict[int, tuple[int, int]]:
+    """{hero_id: (games, wins)} for every hero in hero_stats; TTL-cached snapshot."""
+    global _hero_stats_snapshot
+    snap = _hero_stats_snapshot
+    now = time.monotonic()
+    if snap is not None and now - snap[0] < _HERO_STATS_TTL_SEC:
+        return snap[1]
+    with engine.connect() as conn:
+        stats = {
+            hero_id: (games, wins)
+            for hero_id, games, wins in conn.execute(_ALL_HERO_STATS_SELECT)
+        }
+    _hero_stats_snapshot = (now, stats)
+    return stats
+
+
+def _cached_hero_stat(hero_id: int) -> tuple[int, int]:
+    """(games, wins) for one hero, (0, 0) when it has no row."""
+    return get_all_hero_stats().get(hero_id, (0, 0))
+
+
+def _invalidate_hero_stats_cache() -> None:
+    global _hero_stats_snapshot
+    _hero_stats_snapshot = None
+
+
+def get_hero_games_wins(hero_id: int, strict: bool = False) -> tuple[int, int]:
+    """Returns (games, wins) for a hero; (0, 0) when there is no data.
+
+    One lookup serves both the base winrate and the total game count, so the
+    hero page needs a single query (strict) or snapshot read (normal).
+
+    strict=False: from the hero_stats aggregate snapshot.
     strict=True: counts from match_players for ranked matches only (game_mode=22, lobby_type=7).
     """
     if strict:
@@ -977,21 +1185,25 @@ def get_hero_base_winrate_from_db(hero_id: int, strict: bool = False) -> Optiona
                       AND (m.duration IS NULL OR m.duration >= :min_dur)
                 """),
                 {"id": hero_id, "min_dur": MIN_MATCH_DURATION_SECONDS},
-            ).mappings().fetchone()
-        if not row or not row["games"]:
-            return None
-        return round(row["wins"] / row["games"], 4)
+            ).fetchone()
+        if not row or not row[0]:
+            return 0, 0
+        return row[0], row[1] or 0
 
     # --- normal mode ---
-    with engine.connect() as conn:
-        row = conn.execute(
-            text("SELECT games, wins FROM hero_stats WHERE hero_id = :id"),
-            {"id": hero_id},
-        ).mappings().fetchone()
+    return _cached_hero_stat(hero_id)
+
 
-    if not row or row["games"] == 0:
+def get_hero_base_winrate_from_db(hero_id: int, strict: bool = False) -> Optional[float]:
+    """Returns hero's overall winrate from our match data (None without games).
+
+    strict=False: reads from hero_stats aggregate table (fast).
+    strict=True: counts from match_players for ranked matches only (game_mode=22, lobby_type=7).
+    """
+    games, wins = get_hero_games_wins(hero_id, strict=strict)
+    if games == 0:
         return None
-    return round(row["wins"] / row["games"], 4)
+    return round(wins / games, 4)
 
 
 def get_hero_total_games(hero_id: int, strict: bool = False) -> int:
@@ -1000,28 +1212,7 @@ def get_hero_total_games(hero_id: int, strict: bool = False) -> int:
     strict=False: from hero_stats aggregate.
     strict=True: counts match_players rows for ranked matches only (game_mode=22, lobby_type=7).
     """
-    if strict:
-        with engine.connect() as conn:
-            val = conn.execute(
-                text("""
-                    SELECT COUNT(*) FROM match_players mp
-                    JOIN matches m ON m.match_id = mp.match_id
-                    WHERE mp.hero_id = :id
-                      AND m.game_mode = 22
-                      AND m.lobby_type = 7
-                      AND (m.duration IS NULL OR m.duration >= :min_dur)
-                """),
-                {"id": hero_id, "min_dur": MIN_MATCH_DURATION_SECONDS},
-            ).scalar()
-        return val or 0
-
-    # --- normal mode ---
-    with engine.connect() as conn:
-        row = conn.execute(
-            text("SELECT games FROM hero_stats WHERE hero_id = :id"),
-            {"id": hero_id},
-        ).mappings().fetchone()
-    return row["games"] if row else 0
+    return get_hero_games_wins(hero_id, strict=strict)[0]
 
 
 def get_hero_synergy_rows(hero_id: int, min_games: int = 50, strict: bool = False) -> list[dict]:
@@ -1083,36 +1274,24 @@ def get_hero_synergy_rows(hero_id: int, min_games: int = 50, strict: bool = Fals
 
     # --- normal mode: fast pre-computed aggregate ---
     with engine.connect() as conn:
-        rows = conn.execute(
-            text(
-                "SELECT hero_a, hero_b, games, wins FROM hero_synergy"
-                " WHERE (hero_a = :id OR hero_b = :id) AND games >= :min"
-            ),
-            {"id": hero_id, "min": min_games},
-        ).mappings().all()
-
-    result = []
-    for row in rows:
-        hero_a, hero_b, games, wins = row["hero_a"], row["hero_b"], row["games"], row["wins"]
-        ally_id = hero_b if hero_a == hero_id else hero_a
-        result.append(
-            {
-                "hero_id": ally_id,
-                "games": games,
-                "wins": wins,
-                "wr_vs": round(wins / games, 4) if games > 0 else 0.0,
-            }
-        )
-    return result
+        return [
+            dict(row) for row in conn.execute(
+                _hero_pair_rows_sql("hero_synergy", "wins"),
+                {"id": hero_id, "min": min_games},
+            ).mappings()
+        ]
 
 
 # ---------------------------------------------------------------------------
 # Cleanup & maintenance
 # ---------------------------------------------------------------------------
 
+_MATCHES_COUNT = text("SELECT COUNT(*) FROM matches")
+
+
 def get_matches_count() -> int:
     with engine.connect() as conn:
-        return conn.execute(text("SELECT COUNT(*) FROM matches")).scalar() or 0
+        return conn.execute(_MATCHES_COUNT).scalar() or 0
 
 
 def get_hero_core_items(hero_id: int, top_n: int = 6, min_item_id: int = 50) -> list[dict]:
@@ -1198,147 +1377,295 @@ def get_hero_core_items(hero_id: int, top_n: int = 6, min_item_id: int = 50) ->
     ]
 
 
+# Id-list queries below go through .scalars(): single-column results come back
+# as plain ints without a Row wrapper per row (cleanup can list tens of
+# thousands of ids).
 def get_old_match_ids(older_than_days: int) -> list[int]:
     """Returns match_ids with start_time older than `older_than_days` days."""
     cutoff = int(time.time()) - older_than_days * 86400
     with engine.connect() as conn:
-        rows = conn.execute(
+        return conn.execute(
             text(
                 "SELECT match_id FROM matches"
                 " WHERE start_time < :cutoff ORDER BY start_time ASC"
             ),
             {"cutoff": cutoff},
-        ).fetchall()
-    return [r[0] for r in rows]
+        ).scalars().all()
 
 
 def get_oldest_match_ids(count: int) -> list[int]:
     """Returns the `count` oldest match_ids (for max-cap enforcement)."""
     with engine.connect() as conn:
-        rows = conn.execute(
+        return conn.execute(
             text("SELECT match_id FROM matches ORDER BY start_time ASC LIMIT :n"),
             {"n": count},
-        ).fetchall()
-    return [r[0] for r in rows]
+        ).scalars().all()
 
 
-def delete_matches_and_recalculate(match_ids: list[int]) -> None:
-    """Deletes the specified matches then fully recalculates all aggregates.
+# ---------------------------------------------------------------------------
+# Aggregate rebuild helpers (shared by the two full-rebuild paths below)
+# ---------------------------------------------------------------------------
+
+# Columns the rebuild reads, in the order _accumulate_aggregates unpacks them.
+# Same duration filter as ingest, so rebuilt aggregates match live ingestion.
+_REBUILD_SELECT = text(
+    "SELECT radiant_win, radiant_heroes_packed, radiant_heroes,"
+    " dire_heroes_packed, dire_heroes FROM matches"
+    " WHERE duration IS NULL OR duration >= :min_dur"
+)
+
+
+def _pair_key(a: int, b: int) -> int:
+    """Packs a canonical (min, max) hero pair into one int (ids fit uint16)."""
+    return (a << 16 | b) if a < b else (b << 16 | a)
+
+
+def _accumulate_aggregates(rows) -> tuple[
+    dict[int, list[int]],
+    dict[tuple[int, int], list[int]],
+    dict[tuple[int, int], list[int]],
+    int,
+]:
+    """Counts hero_stats / hero_matchups / hero_synergy from match rows.
+
+    rows — plain row tuples in _REBUILD_SELECT column order (no per-row mapping
+    objects), typically a streamed result consumed once. Returns (stats,
+    matchups, synergy) as {key: [games, wins]} plus the number of matches.
 
-    Recalculation: accumulate in Python dicts → bulk INSERT (faster than
-    per-row upserts when many rows are deleted at once).
+    Pairs are packed into single ints and tallied with Counter.update(),
+    whose counting loop runs in C, instead of allocating a tuple key and
+    mutating a [games, wins] list per pair in Python.
     """
-    if not match_ids:
-        return
+    stat_games: Counter = Counter()
+    stat_wins: Counter = Counter()
+    mu_games: Counter = Counter()
+    mu_wins: Counter = Counter()
+    sy_games: Counter = Counter()
+    sy_wins: Counter = Counter()
+
+    n_matches = 0
+    for radiant_win, r_packed, r_json, d_packed, d_json in rows:
+        n_matches += 1
+        r_heroes = _unpack_heroes(r_packed, r_json)
+        d_heroes = _unpack_heroes(d_packed, d_json)
+        winners, losers = (r_heroes, d_heroes) if radiant_win else (d_heroes, r_heroes)
+
+        stat_games.update(r_heroes)
+        stat_games.update(d_heroes)
+        stat_wins.update(winners)
+
+        # hero_matchups.wins counts hero_a (smaller id): it won when the
+        # smaller hero of the pair is on the winning side.
+        mu_games.update([_pair_key(w, l) for w in winners for l in losers if w != l])
+        mu_wins.update([w << 16 | l for w in winners for l in losers if w < l])
+
+        sy_games.update([_pair_key(x, y) for x, y in combinations(losers, 2)])
+        won_pairs = [_pair_key(x, y) for x, y in combinations(winners, 2)]
+        sy_games.update(won_pairs)
+        sy_wins.update(won_pairs)
+
+    stats = {h: [g, stat_wins[h]] for h, g in stat_games.items()}
+    matchups = {(k >> 16, k & 0xFFFF): [g, mu_wins[k]] for k, g in mu_games.items()}
+    synergy = {(k >> 16, k & 0xFFFF): [g, sy_wins[k]] for k, g in sy_games.items()}
+    return stats, matchups, synergy, n_matches
+
+
+def _insert_aggregates(
+    conn,
+    stats: dict[int, list[int]],
+    matchups: dict[tuple[int, int], list[int]],
+    synergy: dict[tuple[int, int], list[int]],
+) -> None:
+    """Bulk-inserts rebuilt aggregates into the (already wiped) tables.
 
-    with engine.begin() as conn:
-        # Delete player records first (explicit, not relying on FK cascade so
-        # this works on SQLite regardless of PRAGMA foreign_keys setting).
-        conn.execute(
-            text("DELETE FROM match_players WHERE match_id = :id"),
-            [{"id": mid} for mid in match_ids],
+    Goes through the multi-row VALUES path of _insert_rows_ignore: ~14k pair
+    rows become ~60 statements of a couple hundred rows each instead of one
+    statement step per row. The tables are empty, so ON CONFLICT never fires.
+    """
+    pair_cols = ("hero_a", "hero_b", "games", "wins")
+    for table, pairs in (("hero_matchups", matchups), ("hero_synergy", synergy)):
+        _insert_rows_ignore(
+            conn, table, pair_cols, ("hero_a", "hero_b"),
+            [{"hero_a": a, "hero_b": b, "games": g, "wins": w}
+             for (a, b), (g, w) in pairs.items()],
         )
-        # Delete the unwanted matches
-        conn.execute(
-            text("DELETE FROM matches WHERE match_id = :id"),
-            [{"id": mid} for mid in match_ids],
+    _insert_rows_ignore(
+        conn, "hero_stats", ("hero_id", "games", "wins"), ("hero_id",),
+        [{"hero_id": h, "games": g, "wins": w} for h, (g, w) in stats.items()],
+    )
+
+
+# PostgreSQL rebuild: explode both JSON hero lists of every eligible match
+# into (match, side, hero, won) rows once, then GROUP BY straight into the
+# aggregate tables. Pairs keep the canonical hero_a < hero_b order, and wins
+# count hero_a (matchups) / the pair's team (synergy) like ingest does.
+_REBUILD_SIDES_CTE = """
+    WITH sides AS (
+        SELECT m.match_id, s.is_radiant, h.value::int AS hero_id,
+               CASE WHEN (m.radiant_win = 1) = s.is_radiant THEN 1 ELSE 0 END AS won
+        FROM matches m
+        CROSS JOIN LATERAL (VALUES (TRUE, m.radiant_heroes), (FALSE, m.dire_heroes))
+            AS s(is_radiant, heroes)
+        CROSS JOIN LATERAL json_array_elements_text(s.heroes::json) AS h(value)
+        WHERE m.duration IS NULL OR m.duration >= :min_dur
+    )
+"""
+_REBUILD_SQL_PG = (
+    text("INSERT INTO hero_stats (hero_id, games, wins)" + _REBUILD_SIDES_CTE + """
+        SELECT hero_id, COUNT(*), SUM(won) FROM sides GROUP BY hero_id
+    """),
+    text("INSERT INTO hero_matchups (hero_a, hero_b, games, wins)" + _REBUILD_SIDES_CTE + """
+        SELECT x.hero_id, y.hero_id, COUNT(*), SUM(x.won)
+        FROM sides x JOIN sides y
+          ON y.match_id = x.match_id AND y.is_radiant <> x.is_radiant AND y.hero_id > x.hero_id
+        GROUP BY x.hero_id, y.hero_id
+    """),
+    text("INSERT INTO hero_synergy (hero_a, hero_b, games, wins)" + _REBUILD_SIDES_CTE + """
+        SELECT x.hero_id, y.hero_id, COUNT(*), SUM(x.won)
+        FROM sides x JOIN sides y
+          ON y.match_id = x.match_id AND y.is_radiant = x.is_radiant AND y.hero_id > x.hero_id
+        GROUP BY x.hero_id, y.hero_id
+    """),
+)
+_REBUILD_COUNT_PG = text(
+    "SELECT COUNT(*) FROM matches WHERE duration IS NULL OR duration >= :min_dur"
+)
+
+
+def _rebuild_aggregates(conn) -> tuple[int, int, int, int]:
+    """Refills the wiped hero_stats / hero_matchups / hero_synergy tables.
+
+    PostgreSQL aggregates set-based in SQL (_REBUILD_SQL_PG): no match rows
+    leave the server. SQLite, with only basic JSON support, streams the
+    matches through _accumulate_aggregates and inserts the result.
+    Returns (matches_used, heroes, matchup_pairs, synergy_pairs).
+    """
+    params = {"min_dur": MIN_MATCH_DURATION_SECONDS}
+    if conn.dialect.name == "postgresql":
+        n_stats, n_matchups, n_synergy = (
+            conn.execute(stmt, params).rowcount for stmt in _REBUILD_SQL_PG
         )
+        n_matches = conn.execute(_REBUILD_COUNT_PG, params).scalar() or 0
+        return n_matches, n_stats, n_matchups, n_synergy
+
+    # Stream remaining matches (10k rows per fetch) so memory stays flat no
+    # matter how big `matches` grows. The options are per statement:
+    # Connection.execution_options() would mutate `conn` and leave the
+    # server-side cursor on for the INSERTs below.
+    remaining = conn.execute(
+        _REBUILD_SELECT, params,
+        execution_options={"stream_results": True, "yield_per": 10_000},
+    )
+    stats, matchups, synergy, n_matches = _accumulate_aggregates(remaining)
+    _insert_aggregates(conn, stats, matchups, synergy)
+    return n_matches, len(stats), len(matchups), len(synergy)
 
-        # Wipe all aggregates
-        conn.execute(text("DELETE FROM hero_matchups"))
-        conn.execute(text("DELETE FROM hero_synergy"))
-        conn.execute(text("DELETE FROM hero_stats"))
 
-        # Load all remaining matches; apply the same duration filter used at
-        # ingest time so rebuilt aggregates are consistent with live ingestion.
-        remaining = conn.execute(
-            text(
-                "SELECT radiant_win, radiant_heroes, dire_heroes FROM matches"
-                " WHERE duration IS NULL OR duration >= :min_dur"
-            ),
-            {"min_dur": MIN_MATCH_DURATION_SECONDS},
-        ).mappings().all()
+_DELETE_MATCH_PLAYERS = text(
+    "DELETE FROM match_players WHERE match_id IN :ids"
+).bindparams(bindparam("ids", expanding=True))
+_DELETE_MATCHES = text(
+    "DELETE FROM matches WHERE match_id IN :ids"
+).bindparams(bindparam("ids", expanding=True))
 
-        # Accumulate in Python dicts (much faster than per-row upserts)
-        matchups: dict[tuple[int, int], list[int]] = {}
-        synergy: dict[tuple[int, int], list[int]] = {}
-        stats: dict[int, list[int]] = {}
-
-        for row in remaining:
-            radiant_win = bool(row["radiant_win"])
-            r_heroes: list[int] = json.loads(row["radiant_heroes"])
-            d_heroes: list[int] = json.loads(row["dire_heroes"])
-
-            for h in r_heroes:
-                if h not in stats:
-                    stats[h] = [0, 0]
-                stats[h][0] += 1
-                stats[h][1] += int(radiant_win)
-            for h in d_heroes:
-                if h not in stats:
-                    stats[h] = [0, 0]
-                stats[h][0] += 1
-                stats[h][1] += int(not radiant_win)
-
-            for r in r_heroes:
-                for d in d_heroes:
-                    if r == d:
-                        continue
-                    a, b = min(r, d), max(r, d)
-                    a_wins = int((r < d) == radiant_win)
-                    key = (a, b)
-                    if key not in matchups:
-                        matchups[key] = [0, 0]
-                    matchups[key][0] += 1
-                    matchups[key][1] += a_wins
-
-            for heroes, won in [
-                (r_heroes, radiant_win),
-                (d_heroes, not radiant_win),
-            ]:
-                n = len(heroes)
-                for i in range(n):
-                    for j in range(i + 1, n):
-                        a, b = min(heroes[i], heroes[j]), max(heroes[i], heroes[j])
-                        key = (a, b)
-                        if key not in synergy:
-                            synergy[key] = [0, 0]
-                        synergy[key][0] += 1
-                        synergy[key][1] += int(won)
-
-        # Bulk insert recalculated aggregates
-        if matchups:
-            conn.execute(
-                text(
-                    "INSERT INTO hero_matchups (hero_a, hero_b, games, wins)"
-                    " VALUES (:a, :b, :g, :w)"
-                ),
-                [{"a": a, "b": b, "g": v[0], "w": v[1]} for (a, b), v in matchups.items()],
-            )
-        if synergy:
-            conn.execute(
-                text(
-                    "INSERT INTO hero_synergy (hero_a, hero_b, games, wins)"
-                    " VALUES (:a, :b, :g, :w)"
-                ),
-                [{"a": a, "b": b, "g": v[0], "w": v[1]} for (a, b), v in synergy.items()],
-            )
-        if stats:
-            conn.execute(
-                text(
-                    "INSERT INTO hero_stats (hero_id, games, wins) VALUES (:h, :g, :w)"
-                ),
-                [{"h": h, "g": v[0], "w": v[1]} for h, v in stats.items()],
+
+# Cleanup subtracts the deleted matches' contributions while they are at
+# most this share of the table; above it a full rebuild is cheaper.
+_INCREMENTAL_CLEANUP_MAX_SHARE = 0.25
+
+# Deleted matches that contributed to the aggregates (same duration filter
+# as ingest), in _accumulate_aggregates column order.
+_CLEANUP_SELECT = text(
+    "SELECT radiant_win, radiant_heroes_packed, radiant_heroes,"
+    " dire_heroes_packed, dire_heroes FROM matches"
+    " WHERE match_id IN :ids AND (duration IS NULL OR duration >= :min_dur)"
+).bindparams(bindparam("ids", expanding=True))
+
+
+def _subtract_match_aggregates(conn, match_ids: list[int]) -> int:
+    """Reverses ingest for matches about to be deleted; returns how many counted.
+
+    Replays _match_aggregate_rows per match with negated (games, wins) and
+    applies everything through _upsert_counts, then drops pairs/heroes that
+    fell to zero games — the state a full rebuild would leave.
+    """
+    batches = {"hero_stats": [], "hero_matchups": [], "hero_synergy": []}
+    n_matches = 0
+    for start in range(0, len(match_ids), _MAX_BIND_PARAMS):
+        result = conn.execute(_CLEANUP_SELECT, {
+            "ids": match_ids[start:start + _MAX_BIND_PARAMS],
+            "min_dur": MIN_MATCH_DURATION_SECONDS,
+        })
+        for radiant_win, r_packed, r_json, d_packed, d_json in result:
+            n_matches += 1
+            match_rows = _match_aggregate_rows(
+                _unpack_heroes(r_packed, r_json), _unpack_heroes(d_packed, d_json), bool(radiant_win),
             )
+            for rows, table_rows in zip(match_rows, batches.values()):
+                table_rows.extend((*row[:-2], -row[-2], -row[-1]) for row in rows)
+    _upsert_counts(conn, [
+        ("hero_stats", ("hero_id",), batches["hero_stats"]),
+        ("hero_matchups", ("hero_a", "hero_b"), batches["hero_matchups"]),
+        ("hero_synergy", ("hero_a", "hero_b"), batches["hero_synergy"]),
+    ])
+    for table in batches:
+        conn.execute(text(f"DELETE FROM {table} WHERE games <= 0"))
+    return n_matches
+
+
+def delete_matches_and_recalculate(match_ids: list[int]) -> None:
+    """Deletes the specified matches and brings all aggregates up to date.
+
+    When the deleted matches are at most _INCREMENTAL_CLEANUP_MAX_SHARE of
+    the table, their contributions are subtracted (O(deleted) work, see
+    _subtract_match_aggregates). Otherwise the aggregates are wiped and
+    rebuilt: set-based INSERT ... SELECT on PostgreSQL, Python accumulation
+    + bulk INSERT on SQLite (see _rebuild_aggregates).
+    """
+    if not match_ids:
+        return
+    match_ids = list(dict.fromkeys(match_ids))  # a duplicate id must not subtract twice
+
+    with engine.begin() as conn:
+        n_total = conn.execute(_MATCHES_COUNT).scalar() or 0
+        incremental = len(match_ids) <= n_total * _INCREMENTAL_CLEANUP_MAX_SHARE
+        if incremental:
+            # Must read the heroes before the rows are gone.
+            n_subtracted = _subtract_match_aggregates(conn, match_ids)
+
+        # Delete player records first (explicit, not relying on FK cascade so
+        # this works on SQLite regardless of PRAGMA foreign_keys setting),
+        # then the matches. One IN (...) statement per _MAX_BIND_PARAMS ids
+        # instead of an executemany that sends one DELETE per id.
+        for start in range(0, len(match_ids), _MAX_BIND_PARAMS):
+            ids = {"ids": match_ids[start:start + _MAX_BIND_PARAMS]}
+            conn.execute(_DELETE_MATCH_PLAYERS, ids)
+            conn.execute(_DELETE_MATCHES, ids)
+
+        if not incremental:
+            # Wipe all aggregates
+            conn.execute(text("DELETE FROM hero_matchups"))
+            conn.execute(text("DELETE FROM hero_synergy"))
+            conn.execute(text("DELETE FROM hero_stats"))
+
+            # Rebuild from the remaining matches; same duration filter as ingest.
+            n_matches, _, n_matchups, n_synergy = _rebuild_aggregates(conn)
         # engine.begin() auto-commits here
+    _invalidate_hero_stats_cache()
 
+    if incremental:
+        logger.info(
+            "[stats_db] Cleanup done: deleted %d matches, subtracted %d from aggregates",
+            len(match_ids), n_subtracted,
+        )
+        return
     logger.info(
         "[stats_db] Cleanup done: deleted %d matches, remaining=%d,"
         " matchup_pairs=%d, synergy_pairs=%d",
         len(match_ids),
-        len(remaining),
-        len(matchups),
-        len(synergy),
+        n_matches,
+        n_matchups,
+        n_synergy,
     )
 
 
@@ -1367,83 +1694,14 @@ def recalculate_all_aggregates() -> None:
         conn.execute(text("DELETE FROM hero_synergy"))
         conn.execute(text("DELETE FROM hero_stats"))
 
-        remaining = conn.execute(
-            text(
-                "SELECT radiant_win, radiant_heroes, dire_heroes FROM matches"
-                " WHERE duration IS NULL OR duration >= :min_dur"
-            ),
-            {"min_dur": MIN_MATCH_DURATION_SECONDS},
-        ).mappings().all()
-
-        matchups: dict[tuple[int, int], list[int]] = {}
-        synergy: dict[tuple[int, int], list[int]] = {}
-        stats: dict[int, list[int]] = {}
-
-        for row in remaining:
-            radiant_win = bool(row["radiant_win"])
-            r_heroes: list[int] = json.loads(row["radiant_heroes"])
-            d_heroes: list[int] = json.loads(row["dire_heroes"])
-
-            for h in r_heroes:
-                if h not in stats:
-                    stats[h] = [0, 0]
-                stats[h][0] += 1
-                stats[h][1] += int(radiant_win)
-            for h in d_heroes:
-                if h not in stats:
-                    stats[h] = [0, 0]
-                stats[h][0] += 1
-                stats[h][1] += int(not radiant_win)
-
-            for r in r_heroes:
-                for d in d_heroes:
-                    if r == d:
-                        continue
-                    a, b = min(r, d), max(r, d)
-                    a_wins = int((r < d) == radiant_win)
-                    key = (a, b)
-                    if key not in matchups:
-                        matchups[key] = [0, 0]
-                    matchups[key][0] += 1
-                    matchups[key][1] += a_wins
-
-            for heroes, won in [
-                (r_heroes, radiant_win),
-                (d_heroes, not radiant_win),
-            ]:
-                n = len(heroes)
-                for i in range(n):
-                    for j in range(i + 1, n):
-                        a, b = min(heroes[i], heroes[j]), max(heroes[i], heroes[j])
-                        key = (a, b)
-                        if key not in synergy:
-                            synergy[key] = [0, 0]
-                        synergy[key][0] += 1
-                        synergy[key][1] += int(won)
-
-        if matchups:
-            conn.execute(
-                text("INSERT INTO hero_matchups (hero_a, hero_b, games, wins)"
-                     " VALUES (:a, :b, :g, :w)"),
-                [{"a": a, "b": b, "g": v[0], "w": v[1]} for (a, b), v in matchups.items()],
-            )
-        if synergy:
-            conn.execute(
-                text("INSERT INTO hero_synergy (hero_a, hero_b, games, wins)"
-                     " VALUES (:a, :b, :g, :w)"),
-                [{"a": a, "b": b, "g": v[0], "w": v[1]} for (a, b), v in synergy.items()],
-            )
-        if stats:
-            conn.execute(
-                text("INSERT INTO hero_stats (hero_id, games, wins) VALUES (:h, :g, :w)"),
-                [{"h": h, "g": v[0], "w": v[1]} for h, v in stats.items()],
-            )
+        n_matches, n_heroes, n_matchups, n_synergy = _rebuild_aggregates(conn)
         # engine.begin() auto-commits here
+    _invalidate_hero_stats_cache()
 
     logger.info(
         "[stats_db] recalculate_all_aggregates: done"
         " — matches_used=%d, matchup_pairs=%d, synergy_pairs=%d, heroes=%d",
-        len(remaining), len(matchups), len(synergy), len(stats),
+        n_matches, n_matchups, n_synergy, n_heroes,
     )
 
 
@@ -1676,7 +1934,7 @@ def get_match_ids_needing_backfill(limit: int) -> list[int]:
     monotonically forward.
     """
     with engine.connect() as conn:
-        rows = conn.execute(
+        return conn.execute(
             text("""
                 SELECT m.match_id FROM matches m
                 WHERE NOT EXISTS (
@@ -1686,8 +1944,7 @@ def get_match_ids_needing_backfill(limit: int) -> list[int]:
                 LIMIT :lim
             """),
             {"lim": limit},
-        ).fetchall()
-    return [r[0] for r in rows]
+        ).scalars().all()
 
 
 def count_matches_needing_backfill() -> int:
@@ -1714,29 +1971,13 @@ def update_match_players_backfill(match_id: int, players: list[dict]) -> None:
             text("DELETE FROM match_players WHERE match_id = :mid"),
             {"mid": match_id},
         )
-        for p in players:
-            conn.execute(
-                text("""
-                    INSERT INTO match_players
-                        (match_id, hero_id, player_slot, is_radiant,
-                         lane, lane_role, gpm, xpm,
-                         kills, deaths, assists,
-                         hero_damage, tower_damage,
-                         obs_placed, sen_placed,
-                         item0, item1, item2,
-                         last_hits, denies, hero_healing, net_worth,
-                         item3, item4, item5)
-                    VALUES
-                        (:match_id, :hero_id, :player_slot, :is_radiant,
-                         :lane, :lane_role, :gpm, :xpm,
-                         :kills, :deaths, :assists,
-                         :hero_damage, :tower_damage,
-                         :obs_placed, :sen_placed,
-                         :item0, :item1, :item2,
-                         :last_hits, :denies, :hero_healing, :net_worth,
-                         :item3, :item4, :item5)
-                """),
-                {**p, "match_id": match_id},
+        # Same multi-row VALUES path as live ingest: one statement for all
+        # ten players. The DELETE above leaves no rows for the conflict
+        # clause to hit.
+        if players:
+            _insert_rows_ignore(
+                conn, "match_players", _MATCH_PLAYER_COLS, ("match_id", "player_slot"),
+                [{**p, "match_id": match_id} for p in players],
             )
 
 
@@ -1856,17 +2097,21 @@ def get_minigame_hl_pool(force: bool = False) -> list[dict]:
         cutoff = int(time.time()) - _MINIGAME_HL_FALLBACK_DAYS * 86400
         with engine.connect() as conn:
             mrows = conn.execute(
-                text("SELECT radiant_heroes, dire_heroes FROM matches WHERE start_time >= :c"),
+                text(
+                    "SELECT radiant_heroes_packed, radiant_heroes,"
+                    " dire_heroes_packed, dire_heroes"
+                    " FROM matches WHERE start_time >= :c"
+                ),
                 {"c": cutoff},
             ).fetchall()
-        for rh, dh in mrows:
+        picks: Counter = Counter()
+        for r_packed, r_json, d_packed, d_json in mrows:
             try:
-                for blob in (rh, dh):
-                    arr = blob if isinstance(blob, list) else json.loads(blob or "[]")
-                    for h in arr:
-                        pop[int(h)] = pop.get(int(h), 0) + 1
+                picks.update(_unpack_heroes(r_packed, r_json or "[]"))
+                picks.update(_unpack_heroes(d_packed, d_json or "[]"))
             except Exception:
                 continue
+        pop = {int(h): n for h, n in picks.items()}
 
     # Доп.оси kills/deaths из hero_detailed_stats.json — средние за игру.
     detail: dict[int, dict] = {}
@@ -20,7 +20,9 @@ TI-команд с крупных турниров сезона через OpenD
   4) сон FANTASY_POLL_MINUTES, повтор.
 
 Идемпотентность: match_id уже в fantasy_player_stats → пропуск.
-Rate limit: >=1.1с между запросами (OpenDota без ключа: 60/мин, ~3000/день).
+Rate limit: >=1.1с между СТАРТАМИ запросов (OpenDota без ключа: 60/мин,
+~3000/день); детали матчей тянут FANTASY_FETCH_CONCURRENCY воркеров
+параллельно, темп держит общий _pace().
 
 ВАЖНО (исследование 2026-07-15): league_id проверены живыми запросами —
 ранние 171xx-id оказались чужими лигами («Outback Inhouse» и т.п.).
@@ -58,6 +60,9 @@ configure_secure_logging(API_KEY, os.environ.get("DATABASE_URL"))
 
 # Пауза между запросами: без ключа лимит OpenDota 60/мин.
 REQUEST_SLEEP_SECONDS = float(os.environ.get("FANTASY_SLEEP_SECONDS", "1.1"))
+# Сколько /matches/{id} держать в полёте одновременно. Лимит по частоте не
+# меняется (_pace), параллельность лишь перекрывает сетевые RTT ответов.
+FETCH_CONCURRENCY = max(1, int(os.environ.get("FANTASY_FETCH_CONCURRENCY", "4")))
 # Период полного прохода.
 POLL_MINUTES = int(os.environ.get("FANTASY_POLL_MINUTES", "360"))
 # Ограничение новых матчей за один проход (0 = без лимита) — для
@@ -151,18 +156,50 @@ def ensure_tables() -> None:
 #  OpenDota
 # ─────────────────────────────────────────────────────────────────────────────
 
+_pace_lock = asyncio.Lock()
+_next_slot = 0.0
+
+
+async def _pace() -> None:
+    """Старты запросов не чаще раза в REQUEST_SLEEP_SECONDS — на весь процесс,
+    сколько бы воркеров ни ждало ответа параллельно.
+
+    Под локом только выдаётся следующий свободный слот (O(1)), спим уже
+    вне лока: N воркеров получают слоты t, t+Δ, t+2Δ… за один проход и
+    просыпаются каждый к своему, без очереди на самом sleep.
+    """
+    global _next_slot
+    async with _pace_lock:
+        now = time.monotonic()
+        slot = max(now, _next_slot)
+        _next_slot = slot + REQUEST_SLEEP_SECONDS
+    if slot > now:
+        await asyncio.sleep(slot - now)
+
+
+async def _back_off(delay: float) -> None:
+    """Сдвигает общий _next_slot на delay вперёд — паузу держат ВСЕ воркеры.
+
+    На 429/5xx OpenDota нас уже душит: если спит только получивший ошибку,
+    остальные FETCH_CONCURRENCY-1 продолжают брать слоты и добивать API.
+    """
+    global _next_slot
+    async with _pace_lock:
+        _next_slot = max(_next_slot, time.monotonic() + delay)
+
+
 async def _od_get(client: httpx.AsyncClient, path: str) -> list | dict | None:
     """GET с паузой (rate limit) и одним ретраем на 429/5xx. None при неудаче."""
     params = {"api_key": API_KEY} if API_KEY else None
     for attempt in (1, 2):
         try:
+            await _pace()
             r = await client.get(OPENDOTA + path, params=params, timeout=40)
-            await asyncio.sleep(REQUEST_SLEEP_SECONDS)
             if r.status_code == 200:
                 return r.json()
             if r.status_code == 429 or r.status_code >= 500:
                 logger.warning("[od] %s -> %d (attempt %d)", path, r.status_code, attempt)
-                await asyncio.sleep(5.0 * attempt)
+                await _back_off(5.0 * attempt)   # ретрай сам дождётся слота в _pace()
                 continue
             logger.warning("[od] %s -> %d, giving up", path, r.status_code)
             return None
@@ -178,19 +215,20 @@ def _num(v, default=0):
 
 
 def _extract_player_stats(p: dict) -> dict:
+    get = p.get  # 13 обращений на игрока — один bound-метод вместо 13 атрибут-lookup
     return {
-        "kills": int(_num(p.get("kills"))),
-        "deaths": int(_num(p.get("deaths"))),
-        "assists": int(_num(p.get("assists"))),
-        "last_hits": int(_num(p.get("last_hits"))),
-        "gold_per_min": int(_num(p.get("gold_per_min"))),
-        "xp_per_min": int(_num(p.get("xp_per_min"))),
-        "stuns": float(_num(p.get("stuns"), 0.0)),
-        "obs_placed": int(_num(p.get("obs_placed"))),
-        "camps_stacked": int(_num(p.get("camps_stacked"))),
+        "kills": int(_num(get("kills"))),
+        "deaths": int(_num(get("deaths"))),
+        "assists": int(_num(get("assists"))),
+        "last_hits": int(_num(get("last_hits"))),
+        "gold_per_min": int(_num(get("gold_per_min"))),
+        "xp_per_min": int(_num(get("xp_per_min"))),
+        "stuns": float(_num(get("stuns"), 0.0)),
+        "obs_placed": int(_num(get("obs_placed"))),
+        "camps_stacked": int(_num(get("camps_stacked"))),
         # оба имени существуют в API и равны — берём любое присутствующее
-        "tower_kills": int(_num(p.get("tower_kills", p.get("towers_killed")))),
-        "roshan_kills": int(_num(p.get("roshan_kills", p.get("roshans_killed")))),
+        "tower_kills": int(_num(get("tower_kills", get("towers_killed")))),
+        "roshan_kills": int(_num(get("roshan_kills", get("roshans_killed")))),
     }
 
 
@@ -306,31 +344,42 @@ async def collect_once() -> None:
         logger.info("[fantasy] to fetch: %d matches%s", len(match_ids),
                     " (capped by FANTASY_MAX_MATCHES_PER_RUN)" if MAX_MATCHES_PER_RUN else "")
 
-        # 2) Детали + запись.
+        # 2) Детали + запись. FETCH_CONCURRENCY воркеров разбирают общий
+        # итератор match_id: пока один ждёт ответ, другой уже стартует
+        # следующий запрос (в темпе _pace). _store_match синхронный, так что
+        # записи в БД по-прежнему идут строго по одной.
         skipped_unparsed = 0
-        for mid in match_ids:
-            match = await _od_get(client, f"/matches/{mid}")
-            if not match or not match.get("players"):
-                failed += 1
-                continue
-            # Непропаршенный матч (version=null): скаляры уже есть, но
-            # stuns/obs/camps отсутствуют → записали бы нули НАВСЕГДА
-            # (идемпотентность по match_id). Пропускаем — подберём на
-            # следующем проходе, когда OpenDota допарсит.
-            if match.get("version") is None:
-                skipped_unparsed += 1
-                logger.info("[fantasy] match %s not parsed yet, deferred", mid)
-                continue
-            try:
-                rows += _store_match(match, positions)
-            except Exception as e:
-                logger.warning("[fantasy] store %s failed: %s", mid, e)
-                failed += 1
-                continue
-            done += 1
-            if done % 10 == 0:
-                logger.info("[fantasy] progress: %d/%d matches, %d player rows",
-                            done, len(match_ids), rows)
+        pending = iter(match_ids)
+
+        async def fetch_worker() -> None:
+            nonlocal done, rows, failed, skipped_unparsed
+            for mid in pending:
+                match = await _od_get(client, f"/matches/{mid}")
+                if not match or not match.get("players"):
+                    failed += 1
+                    continue
+                # Непропаршенный матч (version=null): скаляры уже есть, но
+                # stuns/obs/camps отсутствуют → записали бы нули НАВСЕГДА
+                # (идемпотентность по match_id). Пропускаем — подберём на
+                # следующем проходе, когда OpenDota допарсит.
+                if match.get("version") is None:
+                    skipped_unparsed += 1
+                    logger.info("[fantasy] match %s not parsed yet, deferred", mid)
+                    continue
+                try:
+                    rows += _store_match(match, positions)
+                except Exception as e:
+                    logger.warning("[fantasy] store %s failed: %s", mid, e)
+                    failed += 1
+                    continue
+                done += 1
+                if done % 10 == 0:
+                    logger.info("[fantasy] progress: %d/%d matches, %d player rows",
+                                done, len(match_ids), rows)
+
+        await asyncio.gather(*(
+            fetch_worker() for _ in range(min(FETCH_CONCURRENCY, len(match_ids)))
+        ))
 
     logger.info("[fantasy] pass done: %d matches stored, %d player rows, "
                 "%d failed, %d deferred (unparsed)",
@@ -354,4 +403,10 @@ async def run_loop() -> None:
 
 
 if __name__ == "__main__":
+    try:
+        import uvloop  # ставится с uvicorn[standard]; на Windows его нет
+    except ImportError:
+        pass
+    else:
+        uvloop.install()
     asyncio.run(run_loop())
@@ -192,6 +192,72 @@ class AbilityIconCacheTests(unittest.TestCase):
             self.assertIsNone(ability_icons.get_ability_icon_path("unknown_ability"))
 
 
+@unittest.skipUnless(importlib.util.find_spec("httpx"), "httpx unavailable")
+class OpenDotaClientTests(unittest.TestCase):
+    def test_transient_statuses_are_retried_with_retry_after(self):
+        from backend import opendota_client
+
+        class Response:
+            def __init__(self, status_code, headers=None):
+                self.status_code = status_code
+                self.headers = headers or {}
+                self.content = b"upstream error"
+
+        client = AsyncMock()
+        client.get.side_effect = [
+            Response(429, {"Retry-After": "2"}),
+            Response(503),
+            Response(200),
+        ]
+        sleep = AsyncMock()
+        with patch.object(opendota_client, "_get_client", return_value=client), patch.object(
+            opendota_client.asyncio, "sleep", sleep
+        ):
+            response = asyncio.run(opendota_client._request("probe", "/heroes"))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(sleep.await_args_list[0].args, (2.0,))
+            self.assertEqual(sleep.await_count, 2)
+
+            client.get.side_effect = [Response(404)]
+            with self.assertRaises(RuntimeError):
+                asyncio.run(opendota_client._request("probe", "/heroes"))
+
+            # Retry-After longer than the retry budget: fail now, don't wait.
+            sleep.reset_mock()
+            client.get.side_effect = [Response(429, {"Retry-After": "30"})]
+            with self.assertRaises(RuntimeError):
+                asyncio.run(opendota_client._request("probe", "/heroes"))
+            sleep.assert_not_awaited()
+
+    def test_identical_inflight_requests_share_one_upstream_call(self):
+        from backend import opendota_client
+
+        class Response:
+            status_code = 200
+
+        async def slow_get(path, **kwargs):
+            await asyncio.sleep(0.01)
+            return Response()
+
+        client = AsyncMock()
+        client.get.side_effect = slow_get
+
+        async def scenario():
+            return await asyncio.gather(
+                opendota_client._request("probe", "/publicMatches", params={"a": 1}),
+                opendota_client._request("probe", "/publicMatches", params={"a": 1}),
+                opendota_client._request("probe", "/publicMatches", params={"a": 2}),
+            )
+
+        with patch.object(opendota_client, "_get_client", return_value=client):
+            first, second, other = asyncio.run(scenario())
+
+        self.assertIs(first, second)
+        self.assertIsNot(first, other)
+        self.assertEqual(client.get.await_count, 2)
+        self.assertEqual(opendota_client._inflight, {})
+
+
 class HeroCatalogTests(unittest.TestCase):
     def test_share_card_catalog_resolves_names_and_portrait_slugs(self):
         from backend.hero_catalog import hero_identity
@@ -336,6 +402,89 @@ class ApiIntegrationTests(unittest.TestCase):
             self.assertNotEqual(stored.token, raw_token)
             self.assertEqual(len(stored.token), 64)
 
+    def test_match_ingest_updates_aggregates_once(self):
+        from backend import stats_db
+
+        radiant, dire = [101, 102, 103, 104, 105], [106, 107, 108, 109, 110]
+        saved = [
+            stats_db.save_match_and_update_aggregates(
+                match_id=880001, start_time=1_700_000_000, duration=2400,
+                patch="7.37", avg_rank_tier=75, rank_bucket="divine",
+                radiant_win=True, radiant_heroes=radiant, dire_heroes=dire,
+                game_mode=22, lobby_type=7,
+            )
+            for _ in range(2)  # второй вызов — повтор того же матча, no-op
+        ]
+        self.assertEqual(saved, [True, False])
+        self.assertEqual(stats_db.get_existing_match_ids([880001, 880002]), {880001})
+
+        with self.api.engine.connect() as conn:
+            stats = dict(conn.execute(
+                sa.text("SELECT hero_id, wins FROM hero_stats WHERE hero_id >= 101 AND hero_id <= 110 AND games = 1")
+            ).all())
+            matchups = conn.execute(
+                sa.text("SELECT hero_a, hero_b, games, wins FROM hero_matchups WHERE hero_a >= 101 AND hero_b <= 110")
+            ).all()
+            synergy = conn.execute(
+                sa.text("SELECT hero_a, hero_b, games, wins FROM hero_synergy WHERE hero_a >= 101 AND hero_b <= 110")
+            ).all()
+
+        self.assertEqual(set(stats), set(radiant + dire))
+        self.assertEqual({h: stats[h] for h in radiant}, dict.fromkeys(radiant, 1))
+        self.assertEqual({h: stats[h] for h in dire}, dict.fromkeys(dire, 0))
+        self.assertEqual(len(matchups), 25)
+        self.assertTrue(all(a < b and games == 1 and wins == 1 for a, b, games, wins in matchups))
+        self.assertEqual(len(synergy), 20)
+        self.assertEqual(
+            {(a, b): wins for a, b, games, wins in synergy if games == 1}[(106, 107)], 0
+        )
+
+    def test_match_cleanup_subtracts_deleted_matches_from_aggregates(self):
+        from backend import stats_db
+
+        def save(match_id, radiant, dire):
+            stats_db.save_match_and_update_aggregates(
+                match_id=match_id, start_time=1_700_000_000, duration=2400,
+                patch="7.37", avg_rank_tier=75, rank_bucket="divine",
+                radiant_win=True, radiant_heroes=radiant, dire_heroes=dire,
+                game_mode=22, lobby_type=7,
+            )
+
+        save(880101, [111, 112, 113, 114, 115], [116, 117, 118, 119, 120])
+        for match_id in (880102, 880103, 880104):
+            save(match_id, [121, 122, 123, 124, 125], [126, 127, 128, 129, 130])
+
+        stats_db.delete_matches_and_recalculate([880101, 880101])
+
+        with self.api.engine.connect() as conn:
+            stats = dict(conn.execute(sa.text(
+                "SELECT hero_id, games FROM hero_stats WHERE hero_id BETWEEN 111 AND 130"
+            )).all())
+            pairs = conn.execute(sa.text(
+                "SELECT COUNT(*) FROM hero_matchups WHERE hero_a BETWEEN 111 AND 120"
+            )).scalar()
+        self.assertEqual(stats, dict.fromkeys(range(121, 131), 3))
+        self.assertEqual(pairs, 0)
+        self.assertEqual(stats_db.get_existing_match_ids([880101, 880102]), {880102})
+
+    def test_stats_column_migrations_add_only_missing_columns(self):
+        from backend import stats_db
+
+        engine = sa.create_engine("sqlite://")
+        with engine.begin() as conn:
+            conn.execute(sa.text("CREATE TABLE matches (match_id BIGINT PRIMARY KEY, game_mode SMALLINT)"))
+            conn.execute(sa.text("CREATE TABLE match_players (match_id BIGINT, player_slot INTEGER)"))
+            for table in ("draft_results", "draft_battles", "user_profiles"):
+                conn.execute(sa.text(f"CREATE TABLE {table} (id INTEGER PRIMARY KEY)"))
+            stats_db._apply_column_migrations(conn)
+            stats_db._apply_column_migrations(conn)  # повторный старт — no-op
+            existing = stats_db._existing_columns(conn, ("matches", "user_profiles"))
+
+        self.assertTrue({"rank_bucket", "lobby_type", "radiant_heroes_packed"} <= existing["matches"])
+        self.assertIn("battle_games_played", existing["user_profiles"])
+        required = stats_db._required_columns("sqlite")
+        self.assertEqual(len(required), len({(t, c) for t, c, _ in required}))
+
     def test_query_string_credentials_are_rejected(self):
         raw_token = self.api.create_token_for_user(9005)
         response = self.client.get(f"/api/profile_full?token={raw_token}")
@@ -1522,6 +1671,37 @@ class MigrationTests(unittest.TestCase):
             self.assertIn("ix_battle_pending_invites_battle_id", indexes)
             self.assertIn("ix_battle_pending_invites_expires_at", indexes)
 
+    def test_packed_match_heroes_are_backfilled(self):
+        import struct
+
+        from alembic.migration import MigrationContext
+        from alembic.operations import Operations
+
+        migration_path = (
+            PROJECT_ROOT / "alembic" / "versions" /
+            "0028_add_packed_match_heroes.py"
+        )
+        spec = importlib.util.spec_from_file_location("migration_0028", migration_path)
+        migration = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(migration)
+        engine = sa.create_engine("sqlite://")
+        with engine.begin() as connection:
+            connection.execute(sa.text(
+                "CREATE TABLE matches (match_id INTEGER PRIMARY KEY, "
+                "radiant_heroes TEXT NOT NULL, dire_heroes TEXT NOT NULL)"
+            ))
+            connection.execute(sa.text(
+                "INSERT INTO matches VALUES (1, '[1, 2, 3, 4, 5]', '[6, 7, 8, 9, 138]')"
+            ))
+            operations = Operations(MigrationContext.configure(connection))
+            with patch.object(migration, "op", operations):
+                migration.upgrade()
+            radiant, dire = connection.execute(sa.text(
+                "SELECT radiant_heroes_packed, dire_heroes_packed FROM matches"
+            )).one()
+            self.assertEqual(struct.unpack("<5H", radiant), (1, 2, 3, 4, 5))
+            self.assertEqual(struct.unpack("<5H", dire), (6, 7, 8, 9, 138))
+
 
 class SourceBoundaryTests(unittest.TestCase):
     def test_privileged_bot_handlers_recheck_server_admin_ids(self):